@@ -0,0 +1,138 @@
+""" Registry of deconvolution backends that all follow one protocol:
+
+    deconvolve(block: np.ndarray, psf: np.ndarray, niter: int) -> np.ndarray (float32, same shape)
+
+Backends are loaded lazily, so a node without TensorFlow can still use the CPU ones. With 'auto'
+the fastest backend that loads on this node is used. It is found with a short calibration run the
+first time and the result is stored per host in ~/.cache/isim_decon/backends_<host>.json.
+Set DECON_BACKEND to force a backend for a job. A backend can bring its memory model (bytes per
+padded voxel and its padding) for the planner, otherwise it is planned with conservative defaults. """
+
+import functools
+import json
+import os
+import socket
+import time
+from typing import Callable, Dict
+
+import numpy as np
+
+import planner
+from cache import cache_dir
+
+# Old names of the modes in file_handling and the scripts
+ALIASES = {'cuda': 'flowdec', 'gpu': 'flowdec', 'tf': 'flowdec', 'cpu': 'numpy'}
+# Block used to time the backends, small enough to take a few seconds on a CPU
+CALIBRATION_SHAPE = (16, 128, 128)
+CALIBRATION_NITER = 5
+
+_LOADERS: Dict[str, Callable] = {}
+
+
+def register(name: str, loader: Callable, bytes_per_voxel: int = None, padding: Callable = None):
+    """ Add a backend, loader() returns its deconvolve function and raises ImportError if the
+    backend can not be used on this node. bytes_per_voxel is its peak memory per padded voxel for
+    plain RL, padding(block_shape, kernel_support) the shape it pads a block to. Without them the
+    planner uses planner.DEFAULT_BYTES_PER_VOXEL and pads to the next power of two after adding
+    the kernel support """
+    _LOADERS[name] = loader
+    if bytes_per_voxel is not None:
+        planner.BYTES_PER_VOXEL[name] = bytes_per_voxel
+    if padding is not None:
+        planner.PADDING[name] = padding
+
+
+def _load_flowdec():
+    import flowdec  # noqa: F401 raises ImportError without flowdec/TensorFlow
+    import cuda_decon
+    return cuda_decon.flowdec_deconvolve
+
+
+def _load_numpy():
+    import numpy_decon
+    return numpy_decon.deconvolve
+
+
+register('flowdec', _load_flowdec)
+register('numpy', _load_numpy)
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name: str) -> Callable:
+    """ deconvolve function of a backend """
+    name = ALIASES.get(name, name)
+    if name not in _LOADERS:
+        raise ValueError(f"Unknown backend {name}, choose from {list(_LOADERS)}")
+    return _LOADERS[name]()
+
+
+def available() -> list:
+    """ Names of the backends that load on this node """
+    names = []
+    for name in _LOADERS:
+        try:
+            get_backend(name)
+            names.append(name)
+        except ImportError as e:
+            print(f"Backend {name} not available: {e}")
+    return names
+
+
+def calibrate(names=None, shape=CALIBRATION_SHAPE, niter=CALIBRATION_NITER) -> Dict[str, float]:
+    """ Seconds per run of every backend on a random block, after one warm-up run """
+    from psf import make_kernel
+    names = available() if names is None else names
+    block = np.random.default_rng(0).random(shape, dtype=np.float32)*100 + 10
+    psf = make_kernel(block)['kernel']
+    times = {}
+    for name in names:
+        deconvolve = get_backend(name)
+        deconvolve(block, psf, niter)
+        t0 = time.perf_counter()
+        deconvolve(block, psf, niter)
+        times[name] = time.perf_counter() - t0
+    return times
+
+
+def _cache_file() -> str:
+    return cache_dir(f"backends_{socket.gethostname()}.json")
+
+
+@functools.lru_cache(maxsize=None)
+def auto_backend() -> str:
+    """ Fastest backend on this node, calibrated once per host """
+    names = available()
+    if not names:
+        raise RuntimeError("No deconvolution backend available")
+    cache_file = _cache_file()
+    try:
+        with open(cache_file) as cache:
+            calibration = json.load(cache)
+        # Recalibrate if backends were installed or removed since
+        if sorted(calibration['times']) == sorted(names):
+            return calibration['backend']
+    except (OSError, ValueError, KeyError):
+        pass
+    print("Calibrating deconvolution backends ", names)
+    times = calibrate(names)
+    backend = min(times, key=times.get)
+    print("Calibration times ", times, " using ", backend)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w') as cache:
+            json.dump({'host': socket.gethostname(), 'shape': list(CALIBRATION_SHAPE),
+                       'niter': CALIBRATION_NITER, 'times': times, 'backend': backend}, cache, indent=2)
+    except OSError as e:
+        print("Could not store backend calibration: ", e)
+    return backend
+
+
+def resolve(name: str = 'auto') -> str:
+    """ Registered backend name for a name, an alias ('cuda', 'gpu', 'cpu') or 'auto' """
+    name = os.environ.get('DECON_BACKEND') or name or 'auto'
+    if name == 'auto':
+        return auto_backend()
+    name = ALIASES.get(name, name)
+    if name not in _LOADERS:
+        raise ValueError(f"Unknown backend {name}, choose from {list(_LOADERS)}")
+    return name
@@ -0,0 +1,86 @@
+""" Background levels of 16-bit stacks from one histogram per slice.
+
+The histograms of all slices come from chunked np.bincount calls, median, percentiles and Otsu
+thresholds are then read from them for all slices at once. With per_stack the histograms of all
+slices are summed and every slice gets the level of the whole stack. """
+
+import numpy as np
+
+N_BINS = 2**16
+# Voxels per bincount call, bounds the memory of the int64 bin indices
+HIST_CHUNK = 2**20
+
+
+def histograms(stack: np.ndarray, per_stack: bool = False) -> np.ndarray:
+    """ (slices, N_BINS) histograms of a (z, y, x) or (y, x) stack. Values outside of the uint16
+    range are clipped, floats are truncated like the uint16 cast for cv2 was """
+    stack = stack.reshape(-1, stack.shape[-2]*stack.shape[-1])
+    hist = np.zeros((stack.shape[0], N_BINS), dtype=np.int64)
+    slices_per_chunk = max(1, HIST_CHUNK//stack.shape[1])
+    for start in range(0, stack.shape[0], slices_per_chunk):
+        chunk = stack[start:start + slices_per_chunk]
+        if chunk.dtype != np.uint16:
+            chunk = np.clip(chunk, 0, N_BINS - 1).astype(np.uint16)
+        bins = chunk + (np.arange(chunk.shape[0], dtype=np.int64)*N_BINS)[:, np.newaxis]
+        hist[start:start + chunk.shape[0]] = np.bincount(bins.ravel(), minlength=chunk.shape[0]*N_BINS
+                                                         ).reshape(chunk.shape[0], N_BINS)
+    if per_stack:
+        hist = hist.sum(axis=0, keepdims=True)
+    return hist
+
+
+def _used_bins(hist: np.ndarray) -> np.ndarray:
+    """ Histograms without the empty bins above the largest value, camera data rarely uses all 16 bits """
+    used = np.flatnonzero(hist.any(axis=0))
+    return hist[:, :used[-1] + 1] if used.size else hist[:, :1]
+
+
+def quantiles(hist: np.ndarray, q: float) -> np.ndarray:
+    """ Quantile q (0-1) per histogram, interpolated like np.quantile """
+    counts = np.cumsum(_used_bins(hist), axis=1)
+    position = q*(counts[:, -1] - 1)
+    lower, fraction = np.floor(position), position - np.floor(position)
+    # Value of the k-th sorted voxel: first bin with more than k voxels up to it
+    value_lower = np.argmax(counts > lower[:, np.newaxis], axis=1)
+    value_upper = np.argmax(counts > (lower + (fraction > 0))[:, np.newaxis], axis=1)
+    return value_lower + fraction*(value_upper - value_lower)
+
+
+def otsu(hist: np.ndarray) -> np.ndarray:
+    """ Otsu threshold per histogram, voxels above it are foreground """
+    hist = _used_bins(hist)
+    probability = hist/np.maximum(hist.sum(axis=1, keepdims=True), 1)
+    omega = np.cumsum(probability, axis=1)
+    mu = np.cumsum(probability*np.arange(hist.shape[1]), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mu[:, -1:]*omega - mu)**2/(omega*(1 - omega))
+    return np.argmax(np.nan_to_num(between, nan=-1, posinf=-1), axis=1).astype(np.float64)
+
+
+def _is_16bit(stack: np.ndarray) -> bool:
+    return stack.dtype in (np.uint8, np.uint16)
+
+
+def quantile_levels(stack: np.ndarray, q: float, per_stack: bool = False) -> np.ndarray:
+    """ Quantile q of every slice (or of the whole stack), one level per slice """
+    n_slices = int(np.prod(stack.shape[:-2]))
+    if _is_16bit(stack):
+        levels = quantiles(histograms(stack, per_stack), q)
+    else:
+        flat = stack.reshape(1 if per_stack else n_slices, -1)
+        levels = np.quantile(flat, q, axis=1)
+    return np.broadcast_to(levels, (n_slices,))
+
+
+def otsu_levels(stack: np.ndarray, per_stack: bool = False) -> np.ndarray:
+    """ Otsu threshold of every slice (or of the whole stack), one level per slice """
+    return np.broadcast_to(otsu(histograms(stack, per_stack)), (int(np.prod(stack.shape[:-2])),))
+
+
+def parse_quantile(background: str) -> float:
+    """ 'median' -> 0.5, 'p5' -> 0.05 """
+    if background == 'median':
+        return 0.5
+    if background.startswith('p'):
+        return float(background[1:])/100
+    raise ValueError(f"Unknown background {background}, use 'median', 'p<percentile>' or a number")
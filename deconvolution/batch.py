@@ -0,0 +1,255 @@
+""" Resumable batch deconvolution of all OME-TIFF files below a folder.
+
+    python batch.py <folder> [--params params.json] [--manifest manifest.json] [--attempts 2]
+                             [--shard i/N] [--merge]
+
+A JSON manifest (decon_manifest.json in the folder by default) records every file with its size,
+modification time, the hash of the parameters, status, output and timing. It is written after
+every change, so a job that is killed can be submitted again: files that are done are skipped,
+failed ones are tried again and the file that was running when the job died is resumed from the
+last complete (t, c) block of its partial output. A changed file or changed parameters start the
+file from scratch.
+
+With --shard i/N (or in a SLURM job array) the files are split into N shards of similar total size
+and this task only runs shard i, with its own manifest decon_manifest_<i>of<N>.json. The state of
+the other manifests in the folder is taken over, so the number of shards can change between
+submissions. merge_reports collects all manifests and per-file reports into
+decon_batch_report.json. """
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+import traceback
+from dataclasses import dataclass, field
+
+from report import report_path, stage_summary, stage_totals, to_json
+
+MANIFEST_NAME = 'decon_manifest.json'
+BATCH_REPORT_NAME = 'decon_batch_report.json'
+
+
+def list_files(folder: str) -> list:
+    """ Raw OME-TIFF files below folder, skipping deconvolved outputs and macOS '._' files """
+    files = []
+    for root, dirs, names in os.walk(folder):
+        for name in sorted(names):
+            if name.endswith('.ome.tif') and not name.startswith('._') and 'decon' not in name:
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+def parse_shard(shard: str) -> tuple:
+    """ 'i/N' -> (i, N), shards count from 0 like SLURM array indices """
+    index, count = (int(part) for part in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {shard} is not one of 0/{count} to {count - 1}/{count}")
+    return index, count
+
+
+def shard_from_env() -> tuple:
+    """ (index, count) of this task in a SLURM job array, None outside of one. The index is the
+    position of the task ID among the IDs of the array (--array=0-7 or stepped, 0-14:2); lists
+    like --array=1,3,5 can not be mapped and raise a ValueError """
+    task_id = os.environ.get('SLURM_ARRAY_TASK_ID')
+    if task_id is None:
+        return None
+    task_id = int(task_id)
+    task_min = int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    task_max = int(os.environ.get('SLURM_ARRAY_TASK_MAX', task_id))
+    step = int(os.environ.get('SLURM_ARRAY_TASK_STEP') or 1)
+    count = os.environ.get('SLURM_ARRAY_TASK_COUNT')
+    count = int(count) if count else (task_max - task_min)//step + 1
+    index, offset = divmod(task_id - task_min, step)
+    if offset or count != (task_max - task_min)//step + 1 or not 0 <= index < count:
+        raise ValueError(f"Task {task_id} of the array {task_min}-{task_max}:{step} with {count} tasks can not "
+                         f"be mapped to a shard, use a range like --array=0-{count - 1} or --shard i/N")
+    return index, count
+
+
+def shard_files(files: list, index: int, count: int) -> list:
+    """ Files of shard index out of count, largest files first to the shard with the least bytes
+    so far. The split only depends on the file list, every task computes the same one """
+    loads = [0]*count
+    shards = [[] for _ in range(count)]
+    for size, file_dir in sorted(((os.path.getsize(file_dir), file_dir) for file_dir in files),
+                                 key=lambda item: (-item[0], item[1])):
+        target = loads.index(min(loads))
+        loads[target] += size
+        shards[target].append(file_dir)
+    return sorted(shards[index])
+
+
+def manifest_files(folder: str) -> list:
+    return sorted(glob.glob(os.path.join(folder, 'decon_manifest*.json')))
+
+
+def params_hash(params: dict) -> str:
+    """ Short hash of the parameters, functions and destripe zones are hashed by their settings """
+    text = json.dumps(to_json(params or {}), sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+@dataclass
+class Manifest():
+    """ Status of every file of a batch, stored as JSON """
+
+    path: str
+    entries: dict = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: str) -> 'Manifest':
+        try:
+            with open(path) as manifest:
+                return cls(path, json.load(manifest)['files'])
+        except FileNotFoundError:
+            return cls(path)
+
+    def save(self):
+        """ Replace the manifest atomically, a job killed while writing leaves the last version """
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as manifest:
+            json.dump({'files': self.entries}, manifest, indent=2)
+        os.replace(temp_path, self.path)
+
+    def entry(self, file_dir: str, key: str) -> dict:
+        """ Entry of a file, a new pending one if the file or the parameters changed since """
+        stat = os.stat(file_dir)
+        entry = self.entries.get(file_dir)
+        if entry is None or (entry['size'], entry['mtime'], entry['params_hash']) != (stat.st_size, stat.st_mtime, key):
+            entry = {'input': file_dir, 'size': stat.st_size, 'mtime': stat.st_mtime, 'params_hash': key,
+                     'status': 'pending', 'output': None, 'attempts': 0, 'error': None,
+                     'started': None, 'finished': None, 'seconds': None}
+            self.entries[file_dir] = entry
+        return entry
+
+    def counts(self) -> dict:
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return counts
+
+
+def run_file(entry: dict, params: dict, manifest: Manifest, attempts: int = 2) -> dict:
+    """ Deconvolve one file of the manifest, up to attempts times """
+    import cuda_decon
+    for attempt in range(attempts):
+        # An entry left 'running' by a killed job or 'failed' has a partial output of the same
+        # file and parameters
+        resume = entry['status'] in ('running', 'failed')
+        entry.update({'status': 'running', 'attempts': entry['attempts'] + 1, 'started': time.time(),
+                      'finished': None, 'seconds': None, 'manifest': os.path.basename(manifest.path)})
+        manifest.save()
+        try:
+            entry['output'] = cuda_decon.decon_ome_stack(entry['input'], params=params, resume=resume)
+            entry.update({'status': 'done', 'error': None})
+        except Exception as e:
+            traceback.print_exc()
+            entry.update({'status': 'failed', 'error': f"{type(e).__name__}: {e}"})
+        entry['finished'] = time.time()
+        entry['seconds'] = entry['finished'] - entry['started']
+        manifest.save()
+        if entry['status'] == 'done':
+            break
+        print(f"Attempt {attempt + 1} of {attempts} failed for {entry['input']}: {entry['error']}")
+    return entry
+
+
+def run_batch(folder: str, params: dict = None, manifest_path: str = None, files: list = None,
+              attempts: int = 2, shard: str = None) -> Manifest:
+    """ Deconvolve all files below folder (or the given files) that are not done yet. shard 'i/N'
+    runs only shard i of N, by default the shard of the SLURM array task if there is one """
+    files = [os.path.abspath(file_dir) for file_dir in (list_files(folder) if files is None else files)]
+    shard = parse_shard(shard) if shard else shard_from_env()
+    if shard is not None and shard[1] > 1:
+        files = shard_files(files, *shard)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(files)} files, {sum(map(os.path.getsize, files))/1024**3:.1f} GB")
+        manifest_path = manifest_path or os.path.join(folder, f"decon_manifest_{shard[0]}of{shard[1]}.json")
+    manifest = Manifest.load(manifest_path or os.path.join(folder, MANIFEST_NAME))
+    # Files that other shards (or an earlier split) got to
+    for other_path in manifest_files(folder):
+        if os.path.abspath(other_path) != os.path.abspath(manifest.path):
+            for file_dir, entry in Manifest.load(other_path).entries.items():
+                if file_dir in files and file_dir not in manifest.entries:
+                    manifest.entries[file_dir] = entry
+    key = params_hash(params)
+    entries = [manifest.entry(file_dir, key) for file_dir in files]
+    manifest.save()
+    todo = [entry for entry in entries
+            if entry['status'] != 'done' or not entry['output'] or not os.path.exists(entry['output'])]
+    print(f"Found {len(files)} images, {len(files) - len(todo)} done, {len(todo)} to deconvolve:")
+    print(*[entry['input'] for entry in todo], sep="\n")
+    print("STARTING DECON!")
+    for idx, entry in enumerate(todo):
+        print(f"[{idx + 1}/{len(todo)}] {entry['input']}")
+        run_file(entry, params, manifest, attempts)
+    print("Batch finished: ", manifest.counts())
+    return manifest
+
+
+def merge_reports(folder: str, path: str = None) -> dict:
+    """ Combine the manifests of all shards and the reports of their files into one report """
+    files = {}
+    for manifest_path in manifest_files(folder):
+        for file_dir, entry in Manifest.load(manifest_path).entries.items():
+            # Manifests that took over a file hold copies of its entry, the latest run counts
+            if file_dir not in files or (entry['started'] or 0) > (files[file_dir]['started'] or 0):
+                files[file_dir] = {'manifest': os.path.basename(manifest_path), **entry}
+    shards = {}
+    for entry in files.values():
+        shard = shards.setdefault(entry['manifest'], {'files': 0, 'input_bytes': 0, 'seconds': 0, 'status': {}})
+        shard['files'] += 1
+        shard['input_bytes'] += entry['size']
+        shard['seconds'] += entry['seconds'] or 0
+        shard['status'][entry['status']] = shard['status'].get(entry['status'], 0) + 1
+    for entry in files.values():
+        if entry['status'] == 'done' and entry['output'] and os.path.exists(report_path(entry['output'])):
+            with open(report_path(entry['output'])) as run_report:
+                run = json.load(run_report)
+            entry.update({'blocks': len(run['blocks']), 'resumed_blocks': run.get('resumed_blocks', 0),
+                          'peak_memory': run['peak_memory'], 'stages': run.get('stage_totals', {})})
+    stages = stage_totals([{'stage': name, **total} for entry in files.values()
+                           for name, total in entry.get('stages', {}).items()])
+    merged = {'folder': os.path.abspath(folder), 'files': len(files),
+              'status': Manifest('', files).counts(),
+              'input_bytes': sum(entry['size'] for entry in files.values()),
+              'seconds': sum(entry['seconds'] or 0 for entry in files.values()),
+              'slowest_shard_seconds': max((shard['seconds'] for shard in shards.values()), default=0),
+              'shards': shards, 'stages': stages, 'entries': sorted(files.values(), key=lambda entry: entry['input'])}
+    path = path or os.path.join(folder, BATCH_REPORT_NAME)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as out:
+        json.dump(merged, out, indent=2)
+    os.replace(temp_path, path)
+    print(f"{merged['files']} files {merged['status']}, {merged['seconds']:.0f} s in total, "
+          f"slowest shard {merged['slowest_shard_seconds']:.0f} s. Report written to {path}")
+    print("\n".join(stage_summary(stages)))
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help="folder searched for .ome.tif files")
+    parser.add_argument('--params', help="JSON file with the decon_ome_stack parameters")
+    parser.add_argument('--manifest', help=f"manifest file, default <folder>/{MANIFEST_NAME}")
+    parser.add_argument('--attempts', type=int, default=2, help="tries per file and run")
+    parser.add_argument('--shard', help="run shard i of N ('i/N'), default from SLURM_ARRAY_TASK_ID")
+    parser.add_argument('--merge', action='store_true', help="only merge the manifests and reports")
+    args = parser.parse_args()
+    if args.merge:
+        merge_reports(args.folder)
+        return
+    params = {'background': 'median', 'backend': 'auto'}
+    if args.params:
+        with open(args.params) as params_file:
+            params = json.load(params_file)
+    manifest = run_batch(args.folder, params, args.manifest, attempts=args.attempts, shard=args.shard)
+    merge_reports(args.folder)
+    if manifest.counts().get('failed'):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
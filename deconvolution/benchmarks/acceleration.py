@@ -0,0 +1,110 @@
+""" Iterations and time accelerated Richardson-Lucy needs to reach the residual of plain RL.
+
+    python benchmarks/acceleration.py [files.ome.tif ...] [--niter 10] [--orders 1 2]
+
+Every file is deconvolved (first timepoint and channel) with niter plain RL iterations. Then the
+accelerated versions run until they reach the same residual |data - kernel*estimate|/|data|.
+Without files a synthetic bead stack is used. """
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy_decon  # noqa: E402
+import phantoms  # noqa: E402
+from ome_io import OmeTiffReader  # noqa: E402
+from psf import make_kernel  # noqa: E402
+
+
+def bead_stack(shape=(32, 255, 255), n_beads=200, sigma=1.67, z_step=0.2, seed=0):
+    """ Random beads blurred with the microscope kernel, with background and Poisson noise """
+    return phantoms.blur(phantoms.beads(shape, n_beads, seed), phantoms.psf(shape, sigma, z_step), seed=seed)
+
+
+def load(file_dir):
+    """ First (t, c) block of a file, cropped to odd sizes like decon_ome_stack does """
+    with OmeTiffReader(file_dir) as reader:
+        block = reader.read_block(0, 0).astype(np.float32)
+        z_step = reader.z_step
+    block = block[:, :block.shape[1] - 1 + block.shape[1] % 2, :block.shape[2] - 1 + block.shape[2] % 2]
+    return (block[0] if block.shape[0] == 1 else block), z_step
+
+
+def residual_tracker(image, kernel):
+    """ callback for numpy_decon.deconvolve that records the relative residual per iteration """
+    data, _ = numpy_decon.pad_block(image, kernel)
+    otf, _ = numpy_decon.get_otf(kernel, data.shape)
+    norm = np.linalg.norm(data)
+    residuals = []
+
+    def callback(iteration, estimate, target=None):
+        residuals.append(float(np.linalg.norm(data - numpy_decon.convolve(estimate, otf))/norm))
+        return target is not None and residuals[-1] <= target
+    return callback, residuals
+
+
+def best_time(function, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def benchmark(name, image, kernel, niter=10, orders=(1, 2), max_factor=5, repeats=3):
+    callback, residuals = residual_tracker(image, kernel)
+    numpy_decon.deconvolve(image, kernel, niter, callback=callback)
+    target = residuals[-1]
+    results = [{'data': name, 'shape': list(image.shape), 'acceleration': 0, 'iterations': niter,
+                'residual': target,
+                'seconds': best_time(lambda: numpy_decon.deconvolve(image, kernel, niter), repeats)}]
+    for order in orders:
+        callback, residuals = residual_tracker(image, kernel)
+        numpy_decon.deconvolve(image, kernel, max_factor*niter, acceleration=order,
+                               callback=lambda iteration, estimate: callback(iteration, estimate, target))
+        iterations = len(residuals)
+        results.append({'data': name, 'shape': list(image.shape), 'acceleration': order,
+                        'iterations': iterations, 'residual': residuals[-1],
+                        'seconds': best_time(lambda: numpy_decon.deconvolve(image, kernel, iterations,
+                                                                            acceleration=order), repeats)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help="OME-TIFF files, a synthetic bead stack if none")
+    parser.add_argument('--niter', type=int, default=10, help="plain RL iterations that set the target")
+    parser.add_argument('--orders', type=int, nargs='+', default=[1, 2], help="acceleration orders")
+    parser.add_argument('--sigma', type=float, default=3.9/2.335, help="lateral kernel sigma in pixels")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.files:
+        data = [(os.path.basename(file_dir), *load(file_dir)) for file_dir in args.files]
+    else:
+        data = [('beads', bead_stack(sigma=args.sigma), 0.2)]
+
+    results = []
+    for name, image, z_step in data:
+        kernel = make_kernel(image, sigma=args.sigma, z_step=z_step)['kernel']
+        results.extend(benchmark(name, image, kernel, args.niter, args.orders, repeats=args.repeats))
+
+    print(f"{'data':<30} {'order':>5} {'iter':>5} {'residual':>10} {'seconds':>8} {'speedup':>8}")
+    for result in results:
+        plain = next(other for other in results if other['data'] == result['data'] and other['acceleration'] == 0)
+        print(f"{result['data']:<30} {result['acceleration']:>5} {result['iterations']:>5} "
+              f"{result['residual']:>10.5f} {result['seconds']:>8.3f} {plain['seconds']/result['seconds']:>8.2f}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Consistency checks that need no data, exits with an error if one fails.
+
+    python benchmarks/checks.py
+
+- fit_kernel keeps the kernel peak on the center slice (n_z//2) that get_otf expects
+- the planner's memory estimate of the numpy backend is not below the peak tracemalloc measures """
+
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy_decon  # noqa: E402
+from planner import estimate_peak_bytes, scheme_name  # noqa: E402
+from psf import fit_kernel, get_kernel  # noqa: E402
+
+
+def check_fit_kernel():
+    failures = []
+    for kernel_z in (17, 16):
+        kernel = get_kernel((kernel_z, 31, 31), sigma=1.67, z_step=0.2)['kernel']
+        for n_z in range(1, 2*kernel_z):
+            fitted = fit_kernel(kernel, n_z)
+            peak = np.unravel_index(np.argmax(fitted), fitted.shape)[0]
+            if fitted.shape[0] != n_z or peak != n_z//2:
+                failures.append(f"fit_kernel({kernel_z} slices, {n_z}): {fitted.shape[0]} slices, peak at {peak}")
+    return failures
+
+
+def check_memory_model(shapes=((8, 64, 64), (20, 96, 96), (256, 256)), niter=6):
+    failures = []
+    for shape in shapes:
+        image = np.random.default_rng(0).random(shape, dtype=np.float32)*100 + 10
+        kernel = get_kernel(shape if len(shape) == 2 else (min(17, shape[0]), *shape[1:]), sigma=1.67,
+                            z_step=0.2)['kernel']
+        if len(shape) == 3:
+            kernel = fit_kernel(kernel, shape[0])
+        for acceleration, stop in [(0, None), (1, None), (2, None), (0, 'change'), (0, 'idiv'), (2, 'idiv')]:
+            # The OTF is part of the peak, it must not come from the cache
+            numpy_decon.OTFS.clear()
+            tracemalloc.start()
+            convergence = numpy_decon.Convergence(stop, 1e-9, 1) if stop else None
+            numpy_decon.deconvolve(image, kernel, niter, acceleration=acceleration, stop=convergence)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            estimate = estimate_peak_bytes(shape, 'numpy', scheme_name(acceleration), kernel, stop)
+            if estimate < peak:
+                failures.append(f"numpy {shape} acceleration {acceleration} stop {stop}: "
+                                f"estimate {estimate/1024**2:.1f} MB < measured {peak/1024**2:.1f} MB")
+    return failures
+
+
+CHECKS = [check_fit_kernel, check_memory_model]
+
+
+def main():
+    failures = []
+    for check in CHECKS:
+        found = check()
+        print(f"{check.__name__}: {'ok' if not found else 'FAILED'}")
+        failures.extend(found)
+    for failure in failures:
+        print("  ", failure)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
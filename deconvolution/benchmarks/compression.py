@@ -0,0 +1,89 @@
+""" Ratio and throughput of the lossless output codecs on deconvolved data.
+
+    python benchmarks/compression.py [file_decon.ome.tif] [--codecs none zstd zlib] [--workers 1 8]
+
+The (t, c) blocks of the file (a synthetic deconvolved bead stack without one) are written with
+OmeTiffWriter for every codec and number of compression threads, then read back and compared. """
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy_decon  # noqa: E402
+from acceleration import bead_stack  # noqa: E402
+from ome_io import OmeTiffReader, OmeTiffWriter  # noqa: E402
+from psf import make_kernel  # noqa: E402
+
+
+def synthetic_file(path, shape=(8, 2048, 2048)):
+    """ OME-TIFF with a deconvolved noisy bead stack """
+    beads = bead_stack(shape, n_beads=2000)
+    kernel = make_kernel(beads, z_step=0.2)['kernel']
+    decon = numpy_decon.deconvolve(beads, kernel, 10)
+    tifffile.imwrite(path, np.clip(decon, 0, 65535).astype(np.uint16)[np.newaxis, :, np.newaxis],
+                     ome=True, metadata={'axes': 'TZCYX', 'PhysicalSizeZ': 0.2})
+
+
+def write(reader, path, compression, workers, level=None):
+    with OmeTiffWriter(path, reader, compression=compression, level=level, workers=workers) as writer:
+        for block in reader.blocks():
+            writer.write_block(*block)
+    return writer.stats
+
+
+def read_back(reader, path):
+    """ Seconds to read the written file, which has to hold the blocks unchanged """
+    t0 = time.perf_counter()
+    written = tifffile.imread(path)
+    seconds = time.perf_counter() - t0
+    original = np.stack([block for _, _, block in reader.blocks()])
+    if not np.array_equal(written.reshape(original.shape), original):
+        raise AssertionError(f"{path} does not read back unchanged")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', nargs='?', help="a deconvolved OME-TIFF, synthetic data if none")
+    parser.add_argument('--codecs', nargs='+', default=['none', 'zstd', 'zlib'])
+    parser.add_argument('--level', type=int, help="compression level, codec default if not given")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_dir = args.file
+        if file_dir is None:
+            file_dir = os.path.join(temp_dir, 'beads_decon.ome.tif')
+            synthetic_file(file_dir)
+        results = []
+        with OmeTiffReader(file_dir) as reader:
+            for codec in args.codecs:
+                for workers in ([1] if codec == 'none' else args.workers):
+                    out_path = os.path.join(temp_dir, f"{codec}_{workers}.ome.tif")
+                    stats = write(reader, out_path, None if codec == 'none' else codec, workers, args.level)
+                    read_seconds = read_back(reader, out_path)
+                    results.append({'codec': codec, 'workers': workers, 'level': args.level, **stats,
+                                    'ratio': stats['raw_bytes']/stats['stored_bytes'],
+                                    'write_mb_per_s': stats['raw_bytes']/1024**2/stats['seconds'],
+                                    'read_mb_per_s': stats['raw_bytes']/1024**2/read_seconds})
+                    os.remove(out_path)
+
+    print(f"{'codec':<6} {'workers':>7} {'ratio':>6} {'write MB/s':>10} {'read MB/s':>10}")
+    for result in results:
+        print(f"{result['codec']:<6} {result['workers']:>7} {result['ratio']:>6.2f} "
+              f"{result['write_mb_per_s']:>10.0f} {result['read_mb_per_s']:>10.0f}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
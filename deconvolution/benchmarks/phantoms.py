@@ -0,0 +1,86 @@
+""" Synthetic test data with known ground truth: beads, filaments and frames with stripe artifacts.
+
+Every phantom returns the ground truth and the data the microscope would record: the truth
+blurred with the make_kernel PSF, on a camera background, with Poisson noise. """
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy_decon  # noqa: E402
+from psf import make_kernel  # noqa: E402
+
+SIGMA = 3.9/2.335
+Z_STEP = 0.2
+BACKGROUND = 100
+
+
+def beads(shape, n_beads=200, seed=0, brightness=(500, 5000)) -> np.ndarray:
+    """ Single bright voxels at random positions """
+    rng = np.random.default_rng(seed)
+    truth = np.zeros(shape, dtype=np.float32)
+    truth[tuple(rng.integers(0, size, n_beads) for size in shape)] = rng.uniform(*brightness, n_beads)
+    return truth
+
+
+def filaments(shape, n_filaments=30, length=None, seed=0) -> np.ndarray:
+    """ Random smooth curves one voxel wide, like microtubules or mitochondria networks """
+    rng = np.random.default_rng(seed)
+    truth = np.zeros(shape, dtype=np.float32)
+    length = length or 2*max(shape[-2:])
+    # Curves stay flat in z for 2D data and change z slowly in 3D
+    scale = np.array([0.2] + [1]*(len(shape) - 1)) if len(shape) == 3 else np.ones(len(shape))
+    for _ in range(n_filaments):
+        position = rng.uniform(0, shape)
+        direction = rng.normal(size=len(shape))*scale
+        points = []
+        for _ in range(length):
+            direction = direction + rng.normal(scale=0.15, size=len(shape))*scale
+            direction /= np.linalg.norm(direction)
+            position = position + 0.5*direction
+            points.append(position)
+        points = np.round(points).astype(int)
+        inside = np.all((points >= 0) & (points < shape), axis=1)
+        truth[tuple(points[inside].T)] = rng.uniform(200, 1000)
+    return truth
+
+
+def stripes(shape, period=8, amplitude=0.3, axis=-2) -> np.ndarray:
+    """ Multiplicative stripe pattern of the iSIM, a cosine along axis """
+    coords = np.arange(shape[axis])
+    profile = 1 + amplitude*np.cos(2*np.pi*coords/period)
+    expand = [np.newaxis]*len(shape)
+    expand[axis] = slice(None)
+    return np.broadcast_to(profile[tuple(expand)], shape).astype(np.float32)
+
+
+def psf(shape, sigma=SIGMA, z_step=Z_STEP) -> np.ndarray:
+    """ The make_kernel PSF for data of shape (z, y, x) or (y, x) """
+    return make_kernel(np.broadcast_to(np.float32(0), shape), sigma=sigma, z_step=z_step)['kernel']
+
+
+def blur(truth, kernel, background=BACKGROUND, seed=0) -> np.ndarray:
+    """ Truth seen through kernel on a camera background with Poisson noise. A 2D kernel blurs the
+    frames of a (t, y, x) series one by one """
+    kernel = kernel.reshape((1,)*(truth.ndim - kernel.ndim) + kernel.shape)
+    padded, crop = numpy_decon.pad_block(truth, kernel)
+    blurred = numpy_decon.convolve(padded, numpy_decon.get_otf(kernel, padded.shape)[0])[crop]
+    return np.random.default_rng(seed).poisson(np.maximum(blurred, 0) + background).astype(np.float32)
+
+
+def phantom(kind: str, shape, seed=0, sigma=SIGMA, z_step=Z_STEP):
+    """ (truth, data) of a phantom: 'beads' and 'filaments' are (z, y, x) stacks, 'stripes' is a
+    (t, y, x) series of filament frames with stripe artifacts """
+    if kind == 'beads':
+        truth = beads(shape, n_beads=int(np.prod(shape))//10000 + 10, seed=seed, brightness=(5000, 50000))
+    elif kind == 'filaments':
+        truth = filaments(shape, seed=seed)
+    elif kind == 'stripes':
+        truth = np.stack([filaments(shape[1:], seed=seed + frame) for frame in range(shape[0])])
+        kernel = psf(shape[1:], sigma)
+        return truth, blur(truth*stripes(truth.shape), kernel, seed=seed)
+    else:
+        raise ValueError(f"Unknown phantom {kind}, choose 'beads', 'filaments' or 'stripes'")
+    return truth, blur(truth, psf(shape, sigma, z_step), seed=seed)
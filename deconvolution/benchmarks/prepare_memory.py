@@ -0,0 +1,79 @@
+""" Time and peak memory of the preprocessing (destriping and background) of one z-stack.
+
+    python benchmarks/prepare_memory.py [--shape 100 2048 2048] [--background median] [--json out.json]
+
+Compares the float32 stack path (prepare.prepare_stack into a preallocated buffer) with the
+former per-slice path (complex128 fft2 per slice, float64 results written back into the uint16
+input). Peak memory is traced with tracemalloc on top of the input stack. """
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import prepare  # noqa: E402
+
+
+def legacy_prepare(images, background, filter_zone_source=prepare.get_filter_zone):
+    """ Per-slice preprocessing as it was before the stack path """
+    for idx in range(images.shape[0]):
+        image = images[idx]
+        level = np.median(image) if background == 'median' else background
+        temp_fft = np.fft.fftshift(np.fft.fft2(image))
+        temp_fft[filter_zone_source(temp_fft)] = 0
+        filtered_img = np.abs(np.fft.ifft2(np.fft.fftshift(temp_fft)))
+        if level < 3:
+            ret, _ = cv2.threshold(filtered_img.astype(np.uint16), 0, 1, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+            level = ret*level
+        filtered_img = filtered_img - level
+        filtered_img[filtered_img < 0] = 0
+        images[idx] = filtered_img
+    return images
+
+
+def measure(function):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[100, 2048, 2048], help="z y x of the stack")
+    parser.add_argument('--background', default='median', help="'median', 'p<percentile>' or a number")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+    background = args.background if args.background.startswith(('median', 'p')) else float(args.background)
+
+    stack = np.random.default_rng(0).gamma(2, 300, args.shape).astype(np.uint16)
+    stack_bytes = stack.nbytes
+    out = np.empty(stack.shape, dtype=np.float32)
+    results = []
+    # The stack path gets a preallocated output like in the pipeline, so only the temporaries count
+    seconds, peak = measure(lambda: prepare.prepare_stack(stack, background, out=out))
+    results.append({'path': 'stack float32', 'seconds': seconds, 'peak_bytes': peak})
+    if background == 'median' or not isinstance(background, str):
+        seconds, peak = measure(lambda: legacy_prepare(stack.copy(), background))
+        results.append({'path': 'per slice float64', 'seconds': seconds, 'peak_bytes': peak - stack_bytes})
+
+    print(f"stack {tuple(args.shape)} uint16, {stack_bytes/1024**2:.0f} MB")
+    print(f"{'path':<20} {'seconds':>8} {'peak MB':>8}")
+    for result in results:
+        print(f"{result['path']:<20} {result['seconds']:>8.2f} {result['peak_bytes']/1024**2:>8.0f}")
+    if args.json:
+        with open(args.json, 'w') as out_file:
+            json.dump({'shape': args.shape, 'background': args.background, 'results': results}, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
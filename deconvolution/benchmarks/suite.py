@@ -0,0 +1,183 @@
+""" Speed, memory and accuracy of the deconvolution on synthetic phantoms, for regression tracking.
+
+    python benchmarks/suite.py [--phantoms beads filaments stripes] [--shape 32 256 256]
+                               [--frames 8 512 512] [--backends numpy] [--json results.json]
+
+Every phantom is written as an OME-TIFF and deconvolved with decon_ome_stack by every available
+backend and every chunking strategy the planner has (whole blocks, z-chunks, tiles; the memory
+budget is set so that the planner picks it). Each case runs in its own process, so its peak RSS
+is its own. The result is compared with the ground truth after a least squares fit of scale and
+offset (the background subtraction changes both): Pearson correlation and the RMS error relative
+to the standard deviation of the truth, also for the raw data as the baseline. Runs on CPU only
+machines, flowdec is only used where it loads. """
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backends  # noqa: E402
+import phantoms  # noqa: E402
+from planner import estimate_peak_bytes, kernel_support, plan_decon, scheme_name  # noqa: E402
+from tiling import kernel_margin  # noqa: E402
+from psf import get_kernel  # noqa: E402
+from report import report_path  # noqa: E402
+
+STRATEGIES = ('whole', 'z', 'tiles')
+
+
+def write_phantom(path, data, z_step=phantoms.Z_STEP, frames=False):
+    """ OME-TIFF of a (z, y, x) stack or, with frames, a (t, y, x) series """
+    data = np.clip(data, 0, 65535).astype(np.uint16)
+    data = data[:, np.newaxis, np.newaxis] if frames else data[np.newaxis, :, np.newaxis]
+    tifffile.imwrite(path, data, ome=True, metadata={'axes': 'TZCYX', 'PhysicalSizeZ': z_step})
+
+
+def strategy_budget(strategy, data_shape, backend, niter, acceleration=0):
+    """ Memory budget for which the planner splits data_shape with strategy, None if it can not """
+    data_shape = [size - 1 + size % 2 for size in data_shape]
+    ndim = len(data_shape)
+    kernel_shape = data_shape if ndim == 2 else [min(17, data_shape[0]), *data_shape[1:]]
+    kernel = get_kernel(kernel_shape, sigma=phantoms.SIGMA, z_step=phantoms.Z_STEP)['kernel']
+    scheme = scheme_name(acceleration)
+    if strategy == 'whole':
+        budget = estimate_peak_bytes(data_shape, backend, scheme, kernel)
+    elif strategy == 'z' and ndim == 3:
+        overlap = 2*kernel_margin(kernel, niter)[0]
+        budget = estimate_peak_bytes((max(1, (data_shape[0] - overlap)//2) + overlap, *data_shape[1:]), backend, scheme, kernel)
+    elif strategy == 'tiles':
+        smallest = (1 + 2*kernel_support(kernel)[0], *data_shape[1:]) if ndim == 3 else data_shape
+        budget = estimate_peak_bytes(smallest, backend, scheme, kernel)//2
+    else:
+        return None
+    plan = plan_decon(data_shape, kernel, niter, budget=budget, backend=backend, scheme=scheme)
+    return budget if plan.mode == strategy else None
+
+
+def accuracy(result, truth):
+    """ Pearson correlation and relative RMS error of result against truth after fitting scale and offset """
+    result, truth = result.ravel().astype(np.float64), truth.ravel().astype(np.float64)
+    design = np.stack([result, np.ones_like(result)], axis=1)
+    fit = design @ np.linalg.lstsq(design, truth, rcond=None)[0]
+    return {'pearson': float(np.corrcoef(result, truth)[0, 1]),
+            'nrmse': float(np.sqrt(np.mean((fit - truth)**2))/truth.std())}
+
+
+def peak_rss() -> int:
+    """ Peak resident memory of this process in bytes, None where it can not be read """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+def run_case(case: dict) -> dict:
+    """ Deconvolve one phantom with one backend and strategy, in the process of its own """
+    import cuda_decon
+    rss_before = peak_rss()
+    params = {'background': 'median', 'backend': case['backend'], 'niter': case['niter'],
+              'memory_budget': case['budget'], 'trace_memory': False, 'result_cache': False}
+    if case['destripe_zones']:
+        params['destripe_zones'] = case['destripe_zones']
+    t0 = time.perf_counter()
+    out_file = cuda_decon.decon_ome_stack(case['file'], params)
+    seconds = time.perf_counter() - t0
+    truth = np.load(case['truth'])
+    result = tifffile.imread(out_file).reshape(truth.shape)
+    data = tifffile.imread(case['file']).reshape(truth.shape)
+    # The pipeline leaves an even last row and column at 0
+    crop = tuple(slice(0, size - 1 + size % 2) for size in truth.shape[-2:])
+    truth, result, data = truth[..., crop[0], crop[1]], result[..., crop[0], crop[1]], data[..., crop[0], crop[1]]
+    with open(report_path(out_file)) as report:
+        plan = json.load(report)['plan']
+    os.remove(out_file)
+    return {'seconds': seconds, 'voxels_per_s': truth.size/seconds, 'peak_rss_bytes': peak_rss(),
+            'rss_after_imports_bytes': rss_before, 'plan': {'mode': plan['mode'], 'n_blocks': plan['n_blocks']},
+            'accuracy': accuracy(result, truth), 'baseline': accuracy(data, truth)}
+
+
+def machine() -> dict:
+    import result_cache
+    return {'host': socket.gethostname(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'code': result_cache.code_version()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--phantoms', nargs='+', default=['beads', 'filaments', 'stripes'])
+    parser.add_argument('--shape', type=int, nargs=3, default=[32, 256, 256], help="z y x of the 3D phantoms")
+    parser.add_argument('--frames', type=int, nargs=3, default=[8, 512, 512], help="t y x of the stripe frames")
+    parser.add_argument('--backends', nargs='+', help="default: all that load on this machine")
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES), choices=STRATEGIES)
+    parser.add_argument('--niter', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        with open(args.run_case) as case:
+            print("RESULT " + json.dumps(run_case(json.load(case))))
+        return
+
+    names = args.backends or backends.available()
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for kind in args.phantoms:
+            frames = kind == 'stripes'
+            shape = args.frames if frames else args.shape
+            truth, data = phantoms.phantom(kind, shape, seed=args.seed)
+            file_dir = os.path.join(temp_dir, f"{kind}.ome.tif")
+            write_phantom(file_dir, data, frames=frames)
+            np.save(os.path.join(temp_dir, f"{kind}_truth.npy"), truth)
+            for name in names:
+                for strategy in args.strategies:
+                    budget = strategy_budget(strategy, shape[1:] if frames else shape, name, args.niter)
+                    if budget is None:
+                        continue
+                    case = {'file': file_dir, 'truth': os.path.join(temp_dir, f"{kind}_truth.npy"),
+                            'backend': name, 'niter': args.niter, 'budget': budget,
+                            'destripe_zones': 'auto' if frames else None}
+                    case_file = os.path.join(temp_dir, 'case.json')
+                    with open(case_file, 'w') as out:
+                        json.dump(case, out)
+                    print(f"{kind} {tuple(shape)} {name} {strategy}", flush=True)
+                    run = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', case_file],
+                                         capture_output=True, text=True)
+                    lines = [line for line in run.stdout.splitlines() if line.startswith('RESULT ')]
+                    result = {'phantom': kind, 'shape': list(shape), 'backend': name, 'strategy': strategy,
+                              'niter': args.niter, 'budget': budget}
+                    if run.returncode or not lines:
+                        result['error'] = run.stderr.strip().splitlines()[-1] if run.stderr.strip() else 'no result'
+                        print("  failed: ", result['error'])
+                    else:
+                        result.update(json.loads(lines[-1][len('RESULT '):]))
+                    results.append(result)
+
+    print(f"{'phantom':<10} {'backend':<8} {'strategy':<8} {'blocks':>6} {'Mvox/s':>7} {'RSS MB':>7} "
+          f"{'pearson':>8} {'nrmse':>6} {'raw nrmse':>9}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['phantom']:<10} {result['backend']:<8} {result['strategy']:<8} failed")
+            continue
+        rss = result['peak_rss_bytes']/1024**2 if result['peak_rss_bytes'] else float('nan')
+        print(f"{result['phantom']:<10} {result['backend']:<8} {result['strategy']:<8} {result['plan']['n_blocks']:>6} "
+              f"{result['voxels_per_s']/1e6:>7.2f} {rss:>7.0f} {result['accuracy']['pearson']:>8.3f} "
+              f"{result['accuracy']['nrmse']:>6.3f} {result['baseline']['nrmse']:>9.3f}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'machine': machine(), 'results': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+""" Process-wide caches for objects that are expensive to build and shared between files,
+like kernels and initialized deconvolvers (each one holds its own TensorFlow graph). """
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+
+def cache_dir(*parts: str) -> str:
+    """ Directory for what is kept between runs, ~/.cache/isim_decon unless XDG_CACHE_HOME is set """
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'isim_decon', *parts)
+
+
+def default_workers() -> int:
+    """ Number of FFT threads, the CPUs this process may run on (respects SLURM/taskset) """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Windows and macOS have no CPU affinity in os
+        return os.cpu_count() or 1
+
+
+class LRUCache():
+    """ Thread-safe mapping that keeps the maxsize most recently used entries. A factory may use
+    the same cache for its own parts. """
+
+    def __init__(self, maxsize: int = 8):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable, factory: Callable):
+        """ Cached value for key, factory() is called to build it if it is not there yet """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            value = factory()
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Kernels keyed on (shape, ndim, sigma, z_step)
+KERNELS = LRUCache(16)
+# Initialized deconvolvers keyed on (backend, ndim, start mode), they do not depend on the data
+# shape or the number of iterations
+DECONVOLVERS = LRUCache(4)
+# Kernel spectra of the numpy backend keyed on (padded shape, kernel shape, kernel digest)
+OTFS = LRUCache(8)
+# Destriping masks keyed on (layout, zone function and its parameters, image shape)
+FILTER_MASKS = LRUCache(16)
@@ -1,25 +1,30 @@
 from typing import Tuple, Callable
-from flowdec import data as fd_data
-from flowdec import restoration as fd_restoration
 from skimage import io
-from scipy import ndimage
 import numpy as np
 import matplotlib.pyplot as plt
-from prepare import prepare_decon, get_filter_zone
+from prepare import prepare_decon, get_filter_zone, detect_stripe_zones
+from ome_io import OmeTiffReader, OmeTiffWriter
+from zarr_io import OmeZarrWriter
+from pipeline import BufferPool, batched, run_pipeline
+from tiling import deconvolve_chunked, deconvolve_tiled, get_chunks
+from planner import plan_batch, plan_decon, scheme_name
+from cache import DECONVOLVERS
+from psf import fit_kernel, get_kernel, make_kernel
+from report import RunReport
+import backends
+import numpy_decon
+import result_cache
 from dataclasses import dataclass
 # import tensorflow_probability as tfp
-import tensorflow as tf
-import h5py as h
 
 import tifffile
-import xmltodict
-from dicttoxml import dicttoxml
 from tqdm import tqdm
 from typing import Union
 import json
 from PIL import Image
 
-import uuid
+import functools
+import itertools
 import time  
 import os  
 import pdb
@@ -27,15 +32,12 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 # os.environ["XLA_PYTHON_CLIENT_ALLOCATOR"] = 'platform'
 
 
-SIZE_LIMIT = 100_000_000
-OVERLAP = 6
-
 def main():
     from Analysis.tools import get_files
     folder = '/nfs/nas22/fs2202/biol_bc_kleele_2/Joshua/240119_RPE1_Torin_Mdivi_MFI8_iSIM/18h'
     files, _ = get_files(folder)
 
-    algo = fd_restoration.RichardsonLucyDeconvolver(2).initialize()
+    algo = get_deconvolver(2)
     kernel = make_kernel(io.imread(files['network'][0]), sigma=3.9/2.355)
     for struct_file in files['network']:
         struct_img = io.imread(struct_file)
@@ -60,26 +62,61 @@ class CudaParams():
     z_step: float = 0.2
     prepared: bool = False
     background: Union[int, str] = 'median'
+    background_per_stack: bool = False  # one background level for all slices of a z-stack
     after_gaussian: float = 2
     destripe: Callable = get_filter_zone
+    niter: int = 10
+    acceleration: int = 0  # order of the Biggs-Andrews extrapolation, 0 for plain RL
+    stop_tol: float = None  # stop early once converged, niter is the maximum then
+    stop_criterion: str = 'change'  # 'change' of the estimate or decrease of the 'idiv'
+    stop_every: int = 5  # iterations between two convergence checks
+    backend: str = 'auto'
 
     def __post_init__(self):
-        self.kernel = make_kernel(np.zeros(self.shape), sigma=self.sigma)
-        self.algo = fd_restoration.RichardsonLucyDeconvolver(self.ndim, start_mode="INPUT").initialize()
+        numpy_decon.check_acceleration(self.acceleration)
+        # Kernels and deconvolvers are cached, so files of the same kind don't build them again
+        self.kernel = get_kernel(self.shape, sigma=self.sigma, z_step=self.z_step)
+        self.backend = backends.resolve(self.backend)
+        self.deconvolve = backends.get_backend(self.backend)
+        self.algo = get_deconvolver(self.ndim, start_mode="INPUT") if self.backend == 'flowdec' else None
+
+    def stop_name(self):
+        """ Stop criterion for the memory planner, None without early stopping """
+        return None if self.stop_tol is None else self.stop_criterion
+
+    def convergence(self):
+        """ New stop criterion for one run, None without early stopping """
+        if self.stop_tol is None:
+            return None
+        return numpy_decon.Convergence(self.stop_criterion, self.stop_tol, self.stop_every)
 
     def to_dict(self):
         class_dict = {'sigma': self.sigma,
                       'z_step': self.z_step,
                       'background': self.background,
-                      'after_gaussian': self.after_gaussian}
+                      'background_per_stack': self.background_per_stack,
+                      'after_gaussian': self.after_gaussian,
+                      'niter': self.niter,
+                      'acceleration': self.acceleration,
+                      'stop_tol': self.stop_tol,
+                      'stop_criterion': self.stop_criterion,
+                      'stop_every': self.stop_every,
+                      'destripe': self.destripe,
+                      'backend': self.backend}
         return class_dict
 
 
-def richardson_lucy(image, params=None, algo=None, kernel=None, prepared=True, background=None):
+def richardson_lucy(image, params=None, algo=None, kernel=None, prepared=True, background=None, niter=10,
+                    acceleration=0, stop=None):
     original_data_type = image.dtype
+    deconvolve = None
+    per_stack = False
     if params is not None:
-        algo, kernel, prepared = params.algo, params.kernel, params.prepared
-        background = params.background
+        deconvolve, kernel, prepared = params.deconvolve, params.kernel, params.prepared
+        niter, acceleration = params.niter, params.acceleration
+        background, per_stack = params.background, params.background_per_stack
+        if stop is None:
+            stop = params.convergence()
         try:
             destripe_zones = params.destripe
         except (KeyError, AttributeError) as e:
@@ -87,264 +124,319 @@ def richardson_lucy(image, params=None, algo=None, kernel=None, prepared=True, b
         # print(params)
     else:
         if algo is None:
-            algo = fd_restoration.RichardsonLucyDeconvolver().initialize()
+            deconvolve = backends.get_backend(backends.resolve())
         if kernel is None:
-            kernel = make_kernel(image, sigma=3.9/2.355)
+            kernel = get_kernel(image.shape, sigma=3.9/2.355)
         if background is None:
             print('no background specified, using 0.85')
             background = 0.85
         destripe_zones = get_filter_zone
     if not prepared:
-        image = prepare_decon(image, background, destripe_zones)
-    res = algo.run(fd_data.Acquisition(data=image, kernel=kernel['kernel']), niter=10).data
-    return res.astype(original_data_type)
-
-
-def make_kernel(image: np.ndarray, sigma=1.67, z_step=0.2):
-    """Make a gaussian kernel that fits the psf of the microscope"""
-    if image.ndim == 3:
-        z_sigma = 0.48/z_step
-        sigma = [z_sigma, sigma, sigma]
-        print("3D images, sigma: ", sigma)
-
-    size = image.shape
-    size = [min([17, x]) for x in size]
-
-    # If even size dimensions crop to have a center pixel
-    kernel = {'kernel': np.zeros(size, dtype=float),
-              'sigma': sigma}
-    kernel['kernel'][tuple(np.array(kernel['kernel'].shape)//2)] = 1
-    kernel['kernel'] = ndimage.gaussian_filter(kernel['kernel'], sigma=sigma)
+        image = prepare_decon(image, background, destripe_zones, per_stack=per_stack)
+    if deconvolve is None and (acceleration or stop is not None):
+        res = tf_deconvolve(image, kernel['kernel'], niter, acceleration, stop=stop)
+    elif deconvolve is None:
+        from flowdec import data as fd_data
+        res = algo.run(fd_data.Acquisition(data=image, kernel=kernel['kernel']), niter=niter).data
+    else:
+        res = deconvolve(image, kernel['kernel'], niter, acceleration=acceleration, stop=stop)
+    return res.astype(original_data_type, copy=False)
+
+
+def richardson_lucy_batch(frames, params, stop=None):
+    """Deconvolve same-shape 2D frames (n, y, x) together in one 3D run of the backend.
+
+    The kernel is one slice thick along the batch axis, so the frames don't mix and all of them
+    share one OTF. A power of two frames avoids padding along the batch axis. All frames share one
+    stop criterion, plan_batch does not batch frames that stop early."""
+    original_data_type = frames.dtype
+    if stop is None:
+        stop = params.convergence()
+    if not params.prepared:
+        # The frames are independent images, each one gets its own background level
+        frames = prepare_decon(frames, params.background, params.destripe)
+    kernel = params.kernel['kernel'][np.newaxis, :, :]
+    res = params.deconvolve(frames, kernel, params.niter, acceleration=params.acceleration, stop=stop)
+    return res.astype(original_data_type, copy=False)
+
+
+def flowdec_deconvolve(block, psf, niter, acceleration=0, stop=None):
+    """flowdec/TensorFlow backend, starting from the input like the other backends"""
+    if acceleration or stop is not None:
+        return tf_deconvolve(block, psf, niter, acceleration, stop=stop)
+    from flowdec import data as fd_data
+    algo = get_deconvolver(block.ndim, start_mode="INPUT")
+    return algo.run(fd_data.Acquisition(data=block, kernel=psf), niter=niter).data
+
+
+def tf_deconvolve(block, psf, niter, acceleration=0, stop=None, epsilon=1e-6):
+    """Richardson-Lucy as a TensorFlow loop outside of flowdec, whose graph runs a fixed number of
+    plain iterations. Used for accelerated RL and early stopping, padding and OTF are the ones of
+    the numpy backend."""
+    import tensorflow as tf
+
+    class TfOps(numpy_decon.ArrayOps):
+        @staticmethod
+        def dot(a, b):
+            return float(tf.reduce_sum(a*b))
+
+        @staticmethod
+        def total(a):
+            return float(tf.reduce_sum(a))
+
+        @staticmethod
+        def positive(a):
+            return tf.maximum(a, 0.)
+
+        @staticmethod
+        def idivergence(data, blurred):
+            valid = (data > 0) & (blurred > 0)
+            log_ratio = tf.math.log(tf.where(valid, data, 1.)/tf.where(valid, blurred, 1.))
+            return float(tf.reduce_sum(data*log_ratio) - tf.reduce_sum(data) + tf.reduce_sum(blurred))
+
+        @staticmethod
+        def copy(a):
+            return a
+
+    padded, crop = numpy_decon.pad_block(block, psf)
+    otf, otf_conj = numpy_decon.get_otf(psf, padded.shape)
+    rfft, irfft = {2: (tf.signal.rfft2d, tf.signal.irfft2d), 3: (tf.signal.rfft3d, tf.signal.irfft3d)}[block.ndim]
+    fft_length = tf.constant(padded.shape, dtype=tf.int32)
+    data, otf, otf_conj = tf.constant(padded), tf.constant(otf), tf.constant(otf_conj)
+
+    def rl_step(estimate):
+        blurred = irfft(rfft(estimate)*otf, fft_length=fft_length)
+        ratio = tf.where(blurred < epsilon, tf.zeros_like(blurred), data/blurred)
+        return tf.maximum(estimate*irfft(rfft(ratio)*otf_conj, fft_length=fft_length), 0.)
+
+    callback = None
+    if stop is not None:
+        callback = stop.bind(data, lambda estimate: irfft(rfft(estimate)*otf, fft_length=fft_length), ops=TfOps)
+    estimate = numpy_decon.rl_iterations(data, rl_step, niter, acceleration, ops=TfOps, callback=callback)
+    return estimate.numpy()[crop]
+
+
+def get_deconvolver(ndim, start_mode="CONSTANT"):
+    """Initialized flowdec deconvolver from the process-wide cache"""
+    from flowdec import restoration as fd_restoration
+    return DECONVOLVERS.get(('flowdec', ndim, start_mode),
+                            lambda: fd_restoration.RichardsonLucyDeconvolver(ndim, start_mode=start_mode).initialize())
 
 
-    kernel['kernel'][kernel['kernel']<1e-6*np.max(kernel['kernel'])] = 0
-    kernel['kernel'] = np.divide(kernel['kernel'], np.sum(kernel['kernel'])).astype(np.float32)
-    return kernel
+def init_algo(image):
+    return get_deconvolver(image.ndim)
 
 
-def init_algo(image):
-    return fd_restoration.RichardsonLucyDeconvolver(image.ndim).initialize()
-
-
-def decon_ome_stack(file_dir, params=None):
-    data = None
-    with tifffile.TiffFile(file_dir) as tif: # , is_mmstack=False, is_ome=True
-        imagej_metadata = tif.imagej_metadata
-        #print('header 4 :', tif._fh.read(4))
-        #print('header[:2]: ', tif._fh.read(4)[:2])
-        my_dict = xmltodict.parse(tif.ome_metadata, force_list={'Plane'})
-        old_metadata = tif.ome_metadata
-        #print(old_metadata)
-        size_t = int(my_dict['OME']['Image']["Pixels"]["@SizeT"])
-        size_z = int(my_dict['OME']['Image']["Pixels"]["@SizeZ"])
-        size_c = int(my_dict['OME']['Image']["Pixels"]["@SizeC"])
-        try:
-            z_step = float(my_dict['OME']['Image']["Pixels"]['@PhysicalSizeZ'])
-        except KeyError:
-            print("Could not get z step size. Will put default 0.2")
-            z_step = 0.2
-        # 'XYCZT' or 'XYZCT' ?
-        dim_order = my_dict['OME']['Image']["Pixels"]["@DimensionOrder"]
-
-        data = tif.asarray()
-    if data is None:
-        print("ATTENION: NORMAL READING OF TIFF FAILED! RESORT TO BASIC! ASSUME 1 TIME POINT & 1 CHANNEL!")
-        data = io.imread(file_dir, plugin='pil')
-    
-        dim_order = 'XYCZT'
-    
-        size_t = 1
-        size_z = data.shape[0]
-        size_c = 1
-
-        z_step = 0.2
-    print(size_t, size_z, size_c)
-    print(dim_order)
-
-    ndim = 2 if size_z == 1 else 3
-    # Make standardized array with all dimensions
-    # time [0], z[1], c[2] if not there, just missing depending on order
-    # If it was recorded differently, swap dimensions
-
-    if size_t == 1:
-        data = np.expand_dims(data, 0)
-
-    if size_z > 1 and size_c > 1 and dim_order == 'XYZCT':
-        data = np.moveaxis(data, 1, 2)
-
-    if size_z == 1:
-        data = np.expand_dims(data, 1)
-    if size_c == 1:
-        data = np.expand_dims(data, 2)
-
-    if size_t != data.shape[0]:
-        size_t = data.shape[0]
-    print("SHAPE", data.shape)
-
-    # Make data odd shaped
-    original_size_data = data.shape
-    pad = tuple(np.zeros((5,2), int))
-    crop = tuple(np.zeros((5,2), int))
-    if data.shape[1]%2 == 0:
-        pad_here = tuple(np.zeros((5,2), int))
-        pad_here[1][1] = 1
-        data = np.pad(data, pad)
-    for dim in [3, 4]:
-        if data.shape[dim]%2 == 0:
-            pad[dim][1] = 1
-            crop[dim][1] = data.shape[dim] - 1
-        else:
-            crop[dim][1] = data.shape[dim]
-    data = data[:, :, :, :crop[3][1], :crop[4][1]]
-
-
-    # Check if data might be too big for GPU and slice
-    my_slices = None
-    if ndim == 3:
-        n_pixels = np.prod(data[0, : ,0, :, :].shape)
-        
-        print(n_pixels)
-        if n_pixels > SIZE_LIMIT:
-            n_stacks = np.ceil(n_pixels/SIZE_LIMIT)
-            print("n_stacks ", n_stacks)
-            n_slices = round(size_z/n_stacks)
-            n_slices = n_slices - 1 if n_slices%2 == 0 else n_slices
-            print("n_slices ", n_slices)
-            print("z ", size_z)
-            my_slices = get_overlapping_slices(size_z, n_slices, OVERLAP)
-            print(my_slices)
-
-    kernel_shape = data.shape[-2:] if ndim==2 else [np.min([17, size_z]), *data.shape[-2:]]
-    # Decon
-    if params is None:
-        background = 100
-    else:
-        background = params['background']
-        try:
-            destripe_zones = params['destripe_zones']
-        except (AttributeError, KeyError) as e:
-            print("No destripe specified.")
+def decon_output_path(file_dir, output_format='tiff'):
+    """ <name>_decon.ome.tif (or <name>_decon.ome.zarr) next to <name>.ome.tif """
+    out_file = os.path.basename(file_dir).rsplit('.', 2)
+    if output_format == 'zarr':
+        out_file[-1] = 'zarr'
+    return os.path.join(os.path.dirname(file_dir), out_file[0] + ".".join(["_decon", *out_file[1:]]))
+
+
+def decon_ome_stack(file_dir, params=None, resume=False):
+    """ Deconvolve all (t, c) blocks of an OME-TIFF file into <name>_decon.ome.tif. With resume the
+    blocks already in a partial output of an interrupted run are kept. Returns the output path """
+    # Time, bytes and memory of every stage go to <output>.stages.csv and the report
+    report = RunReport(file_dir)
+    with report.stage('metadata'):
+        reader = OmeTiffReader(file_dir)
+    with reader:
+        size_t, size_z, size_c = reader.size_t, reader.size_z, reader.size_c
+        z_step = reader.z_step
+        dim_order = reader.dim_order
+        print(size_t, size_z, size_c)
+        print(dim_order)
+
+        ndim = reader.ndim
+        # Standardized output with all dimensions: time [0], z[1], c[2]
+        original_size_data = (size_t, size_z, size_c, *reader.shape)
+        print("SHAPE", original_size_data)
+
+        # Make data odd shaped, the cropped row/column stays 0 in the output
+        crop = [dim - 1 if dim % 2 == 0 else dim for dim in reader.shape]
+
+        data_shape = crop if ndim==2 else [size_z, *crop]
+        kernel_shape = crop if ndim==2 else [np.min([17, size_z]), *crop]
+        # Decon
+        memory_budget = None
+        trace_memory = True
+        use_result_cache, hash_content = True, False
+        output_format, writer_options = 'tiff', {}
+        options = {}
+        if params is None:
+            background = 100
             destripe_zones = get_filter_zone
-     
-    params = CudaParams(background=background, shape=kernel_shape, ndim=ndim, z_step=z_step, destripe=destripe_zones)
-
-    decon = np.empty_like(data)
-    for timepoint in tqdm(range(size_t)):
-        data_t = data[timepoint, :, :, :, :]
-        for channel in range(size_c):
-            data_c = data_t[:, channel, :, :]
+        else:
+            memory_budget = params.get('memory_budget')
+            trace_memory = params.get('trace_memory', True)
+            use_result_cache = params.get('result_cache', True)
+            hash_content = params.get('hash_content', False)
+            # 'zarr' writes an OME-Zarr with a pyramid instead of the OME-TIFF
+            output_format = params.get('output_format', 'tiff')
+            if output_format == 'zarr':
+                writer_options = {'chunks': params.get('zarr_chunks'), 'levels': params.get('zarr_levels')}
+            elif params.get('compression'):
+                # Lossless, the tiles of every plane are compressed in parallel
+                writer_options = {'compression': params['compression'], 'level': params.get('compression_level'),
+                                  'predictor': params.get('predictor', True),
+                                  'workers': params.get('compression_workers')}
+            # Backend and iteration settings are passed on if they are given
+            options = {key: params[key] for key in ['backend', 'niter', 'acceleration', 'stop_tol', 'stop_criterion', 'stop_every',
+                                                  'background_per_stack']
+                       if key in params}
+            background = params['background']
+            try:
+                destripe_zones = params['destripe_zones']
+            except (AttributeError, KeyError) as e:
+                print("No destripe specified.")
+                destripe_zones = get_filter_zone
+
+        # Destriping happens while reading, richardson_lucy gets prepared data
+        params = CudaParams(background=background, shape=kernel_shape, ndim=ndim, z_step=z_step, destripe=destripe_zones,
+                            prepared=True, **options)
+
+        # Nothing is computed if this file was deconvolved with the same settings and code before
+        out_path = decon_output_path(file_dir, output_format)
+        result_key = None
+        if use_result_cache:
+            result_key = result_cache.result_key(file_dir, {**params.to_dict(), 'memory_budget': memory_budget,
+                                                            'output_format': output_format,
+                                                            **{key: value for key, value in writer_options.items()
+                                                               if key != 'workers'}}, content=hash_content)
+            if result_cache.lookup(result_key, out_path):
+                return out_path
+        if isinstance(params.destripe, str) and params.destripe == 'auto':
+            # Stripe peaks of this file from the power spectrum of a few frames
+            with report.stage('destripe'):
+                params.destripe = detect_stripe_zones(reader.sample_frames()[:, :crop[0], :crop[1]])
+            print("Destripe zones ", params.destripe.boxes)
+
+        # Check if data might be too big for the memory and slice in z or tile
+        plan = plan_decon(data_shape, params.kernel['kernel'], niter=params.niter, budget=memory_budget,
+                          backend=params.backend, scheme=scheme_name(params.acceleration), stop=params.stop_name())
+        print(plan.report())
+        report.params, report.plan = params.to_dict(), plan
+        report.result_key = result_key
+        chunk_slices = None
+        tile_shape = None
+        if plan.mode == 'z':
+            chunk_slices, chunk_margin = plan.n_slices, plan.margin[0]
+            print(get_chunks(size_z, chunk_slices, chunk_margin))
+        elif plan.mode == 'tiles':
+            tile_shape, tile_margin = plan.tile_shape, plan.margin
+        # 2D frames that fit are deconvolved in batches stacked along a third axis
+        batch_size = 1
+        if ndim == 2 and plan.mode == 'whole':
+            batch_size = plan_batch(data_shape, size_t*size_c, budget=memory_budget, backend=params.backend,
+                                    scheme=scheme_name(params.acceleration), kernel=params.kernel['kernel'],
+                                    stop=params.stop_name())
+            print("Frames per batch ", batch_size)
+
+        # The prepared float32 blocks go into reused buffers instead of a new stack per block
+        buffers = BufferPool(data_shape)
+
+        def read_block(block):
+            timepoint, channel, data_c = block
+            data_c = data_c[:, :crop[0], :crop[1]]
             if size_z == 1:
                 data_c = data_c[0, :, :]
-            if my_slices is None:
-                if ndim == 3:
-                    padding = (data_c.shape[0] - params.kernel['kernel'].shape[0])//2
-                    params.kernel['kernel'] = np.pad(params.kernel['kernel'],((padding, padding),(0,0),(0,0)))
-                decon[timepoint, :, channel, :, :] = richardson_lucy(data_c, params=params)
-            else:
-                old_kernel_shape = params.kernel['kernel'].shape
-                kernel_shape = None
-                for idx, slices in enumerate(tqdm(my_slices)):
-                    data_here = data_c[slices[0]:slices[1], :, :]
-                    kernel_shape = [slices[1] - slices[0], *data_here.shape[-2:]]
-                    if idx == 0:
-                        # print("0 to ", slices[1]-OVERLAP//2)
-                        decon[timepoint, 0:slices[1]-OVERLAP//2, channel, :, :] = richardson_lucy(data_here, params=params)[0:slices[1]-OVERLAP//2, :, :]
-                    elif slices[1] == size_z:
-                        # print(slices[0]+OVERLAP//2, " to ", size_z)
-                        if params.kernel['kernel'].shape[0] != kernel_shape[0]:
-                            padding = (params.kernel['kernel'].shape[0] - kernel_shape[0] + 1)//2
-                            if padding > 0:
-                                params.kernel['kernel'] = params.kernel['kernel'][padding+1:-padding]
-                            print(params.kernel['kernel'].shape[0], " and ", kernel_shape[0])
-                            print(padding)
-                        # params = CudaParams(background=background, shape=kernel_shape, ndim=ndim, z_step=z_step)
-                        decon[timepoint, slices[0]+OVERLAP//2:slices[1], channel, :, :] = richardson_lucy(data_here, params=params)[OVERLAP//2:, :, :]
-                    else:
-                        # print(slices[0]+OVERLAP//2, " to ", slices[1]-OVERLAP//2)
-                        decon[timepoint, slices[0]+OVERLAP//2:slices[1]-OVERLAP//2, channel, :, :] = richardson_lucy(data_here, params=params)[OVERLAP//2:-OVERLAP//2, :, :]
-                    old_kernel_shape = kernel_shape
-
-    #Crop the data back if we padded it
-    if original_size_data != decon.shape:
-        decon = decon[:, :original_size_data[1], :, :, :]
-    if original_size_data != decon.shape:
-        decon = np.pad(decon, pad)
-    print("DECON SHAPE ", decon.shape)
-
-    # Swap axes back
-    # print("DECON", decon.shape)
-    # if size_z > 1 and size_c > 1 and dim_order == 'XYZCT':
-    #     decon = np.moveaxis(decon, 1, 2)
-    # decon = np.squeeze(decon)
-    # print("DECON READY", decon.shape)
-    # Output
-
-    #Adjust metadata
-#    try:
-#        imagej_metadata['min'] = np.min(decon)
-#        imagej_metadata['max'] = np.max(decon)
-#        imagej_metadata['Ranges'] = (np.min(decon), np.max(decon))
-#        for idx, lut in enumerate(imagej_metadata['LUTs']):
-#            imagej_metadata['LUTs'][idx] = imagej_metadata['LUTs'][idx].tolist()
-#    except TypeError:
-#        print("Could not set imagej_metadata")
-    # info = json.loads(imagej_metadata['Info'])
-    # Construct the correct one here
-    # info['AxisOrder'] = ['position', 'time', 'z', 'channel']
-    # imagej_metadata['Info'] = json.dumps(info)
-
-    out_file = os.path.basename(file_dir).rsplit('.', 2)
-    out_file_tiff = out_file[0] + ".".join(["_decon", *out_file[1:]])
-
-
-    UUID = uuid.uuid1()
-
-    # Naive attempt to save as tiff
-    io.imsave(os.path.join(os.path.dirname(file_dir), out_file_tiff), decon)
-
-    # Get metadata to transfer
-#    with tifffile.TiffReader(file_dir) as reader:
-#        mdInfo = xmltodict.parse(reader.ome_metadata)
-#        #mdInfo['OME']['Image']["Pixels"]["@DimensionOrder"] = "XYZCT"
-#        mdInfo['OME']['Image']['@Name'] = os.path.basename(out_file).split('.')[0]     
-#        for frame_tiffdata in mdInfo['OME']['Image']['Pixels']['TiffData']:
-#            frame_tiffdata['UUID']['@FileName'] = os.path.basename(out_file)
-#            frame_tiffdata['UUID']['#text'] =  'urn:uuid:' + str(UUID)
-
-#    with tifffile.TiffWriter(os.path.join(os.path.dirname(file_dir), out_file_tiff), byteorder='<', ome=True) as tif: 
-#        tif.ome_metadata = old_metadata
-#        tif.write(decon, 
-#                photometric='minisblack', 
-#                rowsperstrip=1532, 
-#                bitspersample=16, 
-#                compression='None', 
-#                resolution=(219780, 219780, 'CENTIMETER'),
-#                metadata=imagej_metadata #{'ImageJ':'1.51s','axes':'TZCYX', 'mode':'composite', 'unit': 'um','Ranges': (190.0, 18780.0, 188.0, 1387.0)}, #,'LUTs': imagej_metadata['LUTs'], 'IJMetadataByteCounts': (28, 2116, 32, 768, 768) }, #'spacing': 0.1499999999999999, 'unit': 'um','Ranges': (190.0, 18780.0, 188.0, 1387.0), 'IJMetadataByteCounts': (28, 2116, 32, 768, 768) },
-#                extratags=[(50838,'int',5,(28, 2116, 32, 768, 768),True),
-#                    (5089,'str',None,imagej_metadata,True),
-#                    (279,'int', 2,(6556960,),True),
-#                    (286,'float',1, 12342.2, True),
-#                    (287,'float',1, -6171.9, True),
-#                    (286,'float',1, 12342.2, True)
-#                    ]
-#                )
-  
-    ### Commented out due to working io.imsave as ome-TIFF above -> saving data storage
-    #hf = h.File(os.path.join(os.path.dirname(file_dir), out_file[0] + "_decon.h5"), 'w')
-    #hf.create_dataset('data',data=decon)
-    #hf.close()
-
-    # Write metadata to the prepared file
-#    my_mdInfo = xmltodict.unparse(mdInfo).encode(encoding='UTF-8', errors='strict')
-#    tifffile.tiffcomment(os.path.join(os.path.dirname(file_dir), out_file), comment=imagej_metadata) # my_mdInfo)
-
-    # with tifffile.TiffWriter(os.path.join(os.path.dirname(file_dir), out_file), bigtiff=True) as tif:
-    #     with tifffile.TiffReader(file_dir) as reader:
-    #         mdInfo = xmltodict.parse(reader.ome_metadata)
-    #         for frame_tiffdata in mdInfo['OME']['Image']['Pixels']['TiffData']:
-    #             frame_tiffdata['UUID']['@FileName'] = os.path.basename(out_file)
-    #         mdInfo = xmltodict.unparse(mdInfo).encode(encoding='UTF-8', errors='strict')
-    #     tif.write(decon, description=mdInfo)
+            return timepoint, channel, prepare_decon(data_c, params.background, params.destripe,
+                                                     out=buffers.take(), per_stack=params.background_per_stack,
+                                                     stage=functools.partial(report.stage, timepoint=timepoint,
+                                                                             channel=channel))
+
+        @functools.lru_cache(maxsize=None)
+        def block_kernel(n_z):
+            # The kernel fitted to blocks of n_z slices, shared read-only by all blocks of the file
+            if ndim == 2:
+                return params.kernel['kernel']
+            kernel = fit_kernel(params.kernel['kernel'], n_z)
+            kernel.setflags(write=False)
+            return kernel
+
+        def decon_block(block):
+            timepoint, channel, data_c = block
+            decon = np.zeros((size_z, *reader.shape), dtype=reader.dtype)
+            decon_c = decon[:, :crop[0], :crop[1]]
+            if size_z == 1:
+                decon_c = decon_c[0, :, :]
+            parts = itertools.count()
+
+            def decon_part(data_part):
+                # Tiles and chunks get their own stop criterion and report entry
+                stop = params.convergence()
+                result = params.deconvolve(data_part, block_kernel(data_part.shape[0]), params.niter,
+                                           acceleration=params.acceleration, stop=stop)
+                report.add_block(timepoint, channel, next(parts), stop)
+                return result
+
+            with report.stage('deconvolve', timepoint, channel, nbytes=data_c.nbytes):
+                if tile_shape is not None:
+                    result = deconvolve_tiled(data_c, decon_part, tile_shape, tile_margin)
+                elif chunk_slices is not None:
+                    result = deconvolve_chunked(data_c, decon_part, chunk_slices, chunk_margin)
+                else:
+                    result = decon_part(data_c)
+            # Back to the data type of the input
+            with report.stage('postfilter', timepoint, channel, nbytes=result.nbytes):
+                decon_c[...] = result
+            buffers.give(data_c)
+            return timepoint, channel, decon
+
+        def decon_batch(batch):
+            if batch_size == 1:
+                return [decon_block(block) for block in batch]
+            frames = np.empty((len(batch), *data_shape), dtype=np.float32)
+            for idx, (_, _, data_c) in enumerate(batch):
+                frames[idx] = data_c
+                buffers.give(data_c)
+            decons = []
+            stop = params.convergence()
+            with report.stage('deconvolve', *batch[0][:2], nbytes=frames.nbytes, blocks=len(batch)):
+                results = richardson_lucy_batch(frames, params=params, stop=stop)
+            for (timepoint, channel, _), frame in zip(batch, results):
+                decon = np.zeros((size_z, *reader.shape), dtype=reader.dtype)
+                with report.stage('postfilter', timepoint, channel, nbytes=frame.nbytes):
+                    decon[0, :crop[0], :crop[1]] = frame
+                decons.append((timepoint, channel, decon))
+                report.add_block(timepoint, channel, 0, stop, batch=len(batch))
+            return decons
+
+        def write_batch(batch):
+            for timepoint, channel, decon in batch:
+                with report.stage('write', timepoint, channel, nbytes=decon.nbytes):
+                    writer.write_block(timepoint, channel, decon)
+
+        if not resume:
+            result_cache.release(out_path)
+        writer_class = OmeZarrWriter if output_format == 'zarr' else OmeTiffWriter
+        with writer_class(out_path, reader, resume=resume, **writer_options) as writer:
+            report.resumed_blocks = writer.n_written
+            # The next block is read and destriped while this one is deconvolved and the last one written
+            def progress(batch):
+                progress_bar.update(len(batch))
+                # Peak memory while the stacks were read, prepared, deconvolved and the last ones written
+                report.add_memory([(timepoint, channel) for timepoint, channel, _ in batch])
+
+            if trace_memory:
+                report.start_memory_trace()
+            try:
+                with tqdm(total=size_t*size_c, initial=writer.n_written) as progress_bar:
+                    run_pipeline(batched(reader.blocks(start=writer.n_written, stage=report.stage), batch_size),
+                                 lambda batch: [read_block(block) for block in batch], decon_batch, write_batch,
+                                 progress=progress)
+            finally:
+                report.stop_memory_trace()
+        report.output = writer.out_file
+        report.add_storage(writer.codec, **writer.stats)
+        print(report.summary())
+        print("Report written to ", report.write(), " and ", report.write_stages())
+        if result_key is not None:
+            result_cache.store(result_key, writer.out_file, file_dir)
+    print("DECONVOLVED ", original_size_data, " TO ", writer.out_file)
+    return writer.out_file
 
 
 def decon_one_frame(file_dir, params=None):
@@ -366,17 +458,5 @@ def decon_one_frame(file_dir, params=None):
     tifffile.imwrite(os.path.join(os.path.dirname(file_dir), out_file), decon)
 
 
-def get_overlapping_slices(total_slices, slice_step, overlap):
-    slice_now = 0
-    my_bins = []
-    while slice_now + overlap <= total_slices:
-        if slice_now + slice_step + overlap < total_slices:
-            my_bins.append((slice_now, slice_now + slice_step + overlap))
-        else:
-            my_bins.append((slice_now, total_slices))
-        slice_now = slice_now + slice_step
-    return my_bins
-
-
 if __name__ == '__main__':
     main()
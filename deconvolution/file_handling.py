@@ -7,39 +7,43 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tifffile
 import xmltodict
-import deconvolve
+import backends
+import cuda_decon
+import result_cache
+from ome_io import tiff_options
+from planner import plan_batch, scheme_name
+from report import to_json
 from tqdm import tqdm
 
 
 
 
 
-def deconvoleStack(file: str, mode: str = 'cpu', cuda_params=None):
-    """ Deconvolve the struct part of a stack of foci/struct data using the deconvolve function
-    in the toolbox."""
+def deconvoleStack(file: str, mode: str = 'auto', cuda_params=None, compression=None):
+    """ Deconvolve the struct part of a stack of foci/struct data with the backend for mode
+    ('auto', a backend name or the old 'cpu'/'cuda'/'gpu'). compression: 'zstd', 'zlib' or None """
     stack_struct =tifffile.imread(file, is_ome=False)
     print(stack_struct.shape)
     stackDecon = np.zeros(stack_struct.shape, dtype=np.uint16)
-    if mode in ['gpu', 'cuda']:
-        import cuda_decon
-    if mode in ['gpu', 'cuda'] and cuda_params is None:
-        cuda_params = cuda_decon.CudaParams()
-
-    for frame in tqdm(range(stack_struct.shape[0])):
-        if mode == 'cpu':
-            stackDecon[frame, :, :] = deconvolve.full_richardson_lucy(stack_struct[frame, :, :])
-        else:
-            stackDecon[frame, :, :] = cuda_decon.richardson_lucy(stack_struct[frame, :, :],
-                                                                 params=cuda_params)
+    if cuda_params is None:
+        cuda_params = cuda_decon.CudaParams(backend=mode)
+
+    # Frames are deconvolved in batches that fit into the memory
+    batch_size = plan_batch(stack_struct.shape[1:], stack_struct.shape[0], backend=cuda_params.backend,
+                            scheme=scheme_name(cuda_params.acceleration), kernel=cuda_params.kernel['kernel'],
+                            stop=cuda_params.stop_name())
+    for start in tqdm(range(0, stack_struct.shape[0], batch_size)):
+        stackDecon[start:start + batch_size] = cuda_decon.richardson_lucy_batch(
+            stack_struct[start:start + batch_size], params=cuda_params)
 
     out_file = file[:-8] + '_decon.tiff'
-    tifffile.imwrite(out_file, stackDecon)
+    tifffile.imwrite(out_file, stackDecon, **tiff_options(compression))
 
 
-def deconvolveFolder(folder, n_threads=10, mode='cpu', cuda_params=None, subfolder=None):
+def deconvolveFolder(folder, n_threads=10, mode='auto', cuda_params=None, subfolder=None):
     """ Wrapper function for deconvolveOneFolder to allow for parallel computation """
 
-    if isinstance(folder, list) and mode == 'cpu':
+    if isinstance(folder, list) and backends.resolve(mode) == 'numpy':
         with Pool(n_threads) as p:
             p.map(deconvolveOneFolder, folder, subfolder)
     elif isinstance(folder, list):
@@ -49,37 +53,39 @@ def deconvolveFolder(folder, n_threads=10, mode='cpu', cuda_params=None, subfold
         deconvolveOneFolder(folder, mode, cuda_params, subfolder)
 
 
-def deconvolveOneFolder(folder, mode='cpu', cuda_params=None, subfolder=None, channel='network'):
-    """ Deconvolve the struct frames in a folder of foci/struct data using the deconvolve function
-    in the toolbox. """
-    if mode == 'cuda':
-        import cuda_decon
-
-    if cuda_params is None and mode == 'cuda':
+def deconvolveOneFolder(folder, mode='auto', cuda_params=None, subfolder=None, channel='network', compression=None):
+    """ Deconvolve the struct frames in a folder of foci/struct data with the backend for mode
+    ('auto', a backend name or the old 'cpu'/'cuda'/'gpu'). compression: 'zstd', 'zlib' or None """
+    if cuda_params is None:
         print('Using default coda_params')
-        cuda_params = cuda_decon.CudaParams(background=1.05, sigma=3.9/2.335)  # 0.92 mito 1 for caulo highlight
+        cuda_params = cuda_decon.CudaParams(background=1.05, sigma=3.9/2.335, backend=mode)  # 0.92 mito 1 for caulo highlight
     print('sigma: ', cuda_params.kernel['sigma'], '\nbackground: ', cuda_params.background)
 
     print(folder)
     files, _ = get_files(folder)
     files = files[channel]
+    params = {**cuda_params.to_dict(), 'compression': compression}
+    if subfolder is not None:
+        os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+        with open(os.path.join(folder, subfolder, 'params.txt'), 'w') as outp:
+            outp.write(json.dumps(to_json(params)))
     for idx, file in enumerate(tqdm(files)):
-        struct_img = io.imread(file)
-        if mode == 'cpu':
-            decon_img = deconvolve.full_richardson_lucy(struct_img)
-        elif mode == 'cuda':
-            decon_img = cuda_decon.richardson_lucy(struct_img, params=cuda_params)
-
-        if cuda_params.after_gaussian:
-            decon_img = cv2.GaussianBlur(decon_img, (0, 0), cuda_params.after_gaussian)
-
         if subfolder is None:
             out_file = file[:-8] + 'decon.tiff'
         else:
-            os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
             filename = os.path.basename(file)[:-12] + str(idx).zfill(4) + '.decon.tiff'
             out_file = os.path.join(folder, subfolder, filename)
-            with open(os.path.join(folder, subfolder, 'params.txt'), 'w') as outp:
-                outp.write(json.dumps(cuda_params.to_dict()))
+        # Frames that were deconvolved with the same settings and code are not done again
+        result_key = result_cache.result_key(file, params)
+        if result_cache.lookup(result_key, out_file):
+            continue
+
+        struct_img = io.imread(file)
+        decon_img = cuda_decon.richardson_lucy(struct_img, params=cuda_params)
+
+        if cuda_params.after_gaussian:
+            decon_img = cv2.GaussianBlur(decon_img, (0, 0), cuda_params.after_gaussian)
 
-        tifffile.imwrite(out_file, decon_img)
\ No newline at end of file
+        result_cache.release(out_file)
+        tifffile.imwrite(out_file, decon_img, **tiff_options(compression))
+        result_cache.store(result_key, out_file, file)
\ No newline at end of file
@@ -0,0 +1,234 @@
+""" Richardson-Lucy deconvolution on the CPU with NumPy/SciPy, for nodes without a GPU.
+
+Works like the flowdec path: the data is reflect-padded, the kernel is zero-padded around the
+center and the iterations run in float32 on real FFTs. The kernel spectrum (OTF) is computed once
+per padded shape and kernel and kept in a process-wide cache, so files of the same kind reuse it. """
+
+import hashlib
+
+import numpy as np
+from scipy import fft
+
+from cache import OTFS, default_workers
+from planner import backend_padded_shape
+from prepare import prepare_decon, get_filter_zone
+from psf import get_kernel
+
+
+def get_otf(kernel: np.ndarray, shape, workers: int = None):
+    """ (OTF, conjugate OTF) of kernel for data padded to shape, from the process-wide cache.
+
+    The arrays are read-only, they are shared between all calls with the same kernel."""
+    shape = tuple(int(size) for size in shape)
+    kernel = np.asarray(kernel, dtype=np.float32)
+    key = (shape, kernel.shape, hashlib.sha1(np.ascontiguousarray(kernel).tobytes()).hexdigest())
+
+    def build():
+        # Center the kernel in the padded shape, then move its center to the origin
+        padded = np.zeros(shape, dtype=np.float32)
+        slices = []
+        for size, k_size in zip(shape, kernel.shape):
+            k_start = max(0, k_size//2 - size//2)
+            k_stop = min(k_size, k_start + size)
+            start = size//2 - (k_size//2 - k_start)
+            slices.append((slice(start, start + k_stop - k_start), slice(k_start, k_stop)))
+        padded[tuple(sl[0] for sl in slices)] = kernel[tuple(sl[1] for sl in slices)]
+        padded /= np.sum(padded)
+        otf = fft.rfftn(fft.ifftshift(padded), workers=workers or default_workers()).astype(np.complex64)
+        otf_conj = np.conj(otf)
+        otf.setflags(write=False)
+        otf_conj.setflags(write=False)
+        return otf, otf_conj
+    return OTFS.get(key, build)
+
+
+def pad_block(image: np.ndarray, kernel: np.ndarray):
+    """ float32 image reflect-padded for the FFTs and the slices that crop the padding again.
+
+    The padding is at least the kernel support, so the circular convolution does not mix
+    opposite borders of the image."""
+    shape = backend_padded_shape(image.shape, kernel, 'numpy')
+    pad = [((size - img_size)//2, size - img_size - (size - img_size)//2)
+           for size, img_size in zip(shape, image.shape)]
+    data = np.pad(image.astype(np.float32, copy=False), pad, mode='reflect')
+    return data, tuple(slice(before, before + size) for (before, _), size in zip(pad, image.shape))
+
+
+def convolve(image: np.ndarray, otf: np.ndarray, workers: int = None) -> np.ndarray:
+    """ Circular convolution of a padded image with the kernel of otf """
+    spectrum = fft.rfftn(image, workers=workers or default_workers())
+    spectrum *= otf
+    return fft.irfftn(spectrum, s=image.shape, workers=workers or default_workers(), overwrite_x=True)
+
+
+class ArrayOps():
+    """ Array operations of the iteration loop, numpy here, other backends override them """
+
+    @staticmethod
+    def dot(a, b) -> float:
+        return float(np.vdot(a, b))
+
+    @staticmethod
+    def total(a) -> float:
+        return float(np.sum(a))
+
+    @staticmethod
+    def positive(a):
+        return np.maximum(a, 0, out=a)
+
+    @staticmethod
+    def copy(a):
+        return a.copy()
+
+    @staticmethod
+    def idivergence(data, blurred) -> float:
+        """ I-divergence (Csiszar) between the data and the blurred estimate """
+        valid = (data > 0) & (blurred > 0)
+        return float(np.sum(data[valid]*np.log(data[valid]/blurred[valid])) - np.sum(data) + np.sum(blurred))
+
+
+class Convergence():
+    """ Stop criterion for the RL iterations, checked every check_every iterations.
+
+    'change': relative change of the estimate in the last iteration below tol.
+    'idiv': relative decrease of the I-divergence between data and blurred estimate since the
+    last check below tol (costs one convolution per check).
+    After a run iterations holds the iterations done and residual the last value of the criterion
+    (relative change or I-divergence per data sum)."""
+
+    def __init__(self, criterion: str = 'change', tol: float = 1e-3, check_every: int = 5):
+        if criterion not in ['change', 'idiv']:
+            raise ValueError(f"Unknown stop criterion {criterion}, use 'change' or 'idiv'")
+        self.criterion = criterion
+        self.tol = tol
+        self.check_every = max(1, int(check_every))
+        self.iterations = 0
+        self.residual = None
+        self.converged = False
+
+    def bind(self, data, blur, ops=ArrayOps):
+        """ Callback for rl_iterations on the padded data, blur(estimate) convolves with the kernel """
+        self._data, self._blur, self._ops = data, blur, ops
+        self._data_sum = ops.total(data)
+        self._previous = None
+        self._last_idiv = None
+        self.iterations, self.residual, self.converged = 0, None, False
+        return self
+
+    def __call__(self, iteration: int, estimate) -> bool:
+        self.iterations = iteration
+        if iteration % self.check_every == 0:
+            if self.criterion == 'change' and self._previous is not None:
+                difference = estimate - self._previous
+                self.residual = (self._ops.dot(difference, difference)/
+                                 max(self._ops.dot(self._previous, self._previous), 1e-30))**0.5
+                self.converged = self.residual < self.tol
+            elif self.criterion == 'idiv':
+                self.residual = self._ops.idivergence(self._data, self._blur(estimate))/max(self._data_sum, 1e-30)
+                if self._last_idiv is not None:
+                    self.converged = (self._last_idiv - self.residual) < self.tol*abs(self._last_idiv)
+                self._last_idiv = self.residual
+        # The relative change needs the estimate of the iteration before a check
+        if self.criterion == 'change' and (iteration + 1) % self.check_every == 0:
+            self._previous = self._ops.copy(estimate)
+        return self.converged
+
+
+# Orders of the Biggs-Andrews extrapolation, 0 is plain RL
+ACCELERATIONS = (0, 1, 2)
+
+
+def check_acceleration(acceleration: int):
+    """ ValueError for an acceleration order rl_iterations does not implement """
+    if acceleration not in ACCELERATIONS:
+        raise ValueError(f"Unknown acceleration {acceleration}, choose from {list(ACCELERATIONS)}")
+
+
+def rl_iterations(estimate, rl_step, niter: int, acceleration: int = 0, ops=ArrayOps, callback=None):
+    """ Run niter Richardson-Lucy updates estimate = rl_step(estimate).
+
+    rl_step may overwrite its argument. callback(iteration, estimate) is called after every update,
+    the loop stops early if it returns True. With acceleration 1 or 2 every update starts from a
+    vector extrapolation of the last estimates of that order (Biggs & Andrews, Appl. Opt. 1997),
+    with the step length taken from the correlation of the last two RL updates."""
+    check_acceleration(acceleration)
+    if not acceleration:
+        for iteration in range(niter):
+            estimate = rl_step(estimate)
+            if callback is not None and callback(iteration + 1, estimate):
+                break
+        return estimate
+
+    previous = []  # x_{k-1}, x_{k-2}
+    updates = []  # g_{k-1}, g_{k-2}, the changes rl_step made to the extrapolated points
+    for iteration in range(niter):
+        prediction = estimate
+        if len(updates) == 2:
+            alpha = ops.dot(updates[0], updates[1])/max(ops.dot(updates[1], updates[1]), 1e-30)
+            alpha = min(max(alpha, 0.), 1.)
+            step = estimate - previous[0]
+            prediction = estimate + alpha*step
+            if acceleration > 1 and len(previous) == 2:
+                prediction = prediction + alpha**2/2*(step - (previous[0] - previous[1]))
+            prediction = ops.positive(prediction)
+        new_estimate = rl_step(ops.copy(prediction))
+        updates = [new_estimate - prediction, *updates[:1]]
+        previous = [estimate, *previous[:acceleration - 1]]
+        estimate = new_estimate
+        if callback is not None and callback(iteration + 1, estimate):
+            break
+    return estimate
+
+
+def deconvolve(image: np.ndarray, kernel: np.ndarray, niter: int = 10, epsilon: float = 1e-6,
+               workers: int = None, acceleration: int = 0, stop: Convergence = None,
+               callback=None) -> np.ndarray:
+    """ Richardson-Lucy deconvolution of image (2D or 3D) starting from the image, float32 result.
+
+    acceleration is the order of the Biggs-Andrews extrapolation, 0 for plain RL. With stop the
+    iterations end once they converged, niter is the maximum then. callback gets the padded
+    estimate, see rl_iterations."""
+    workers = workers or default_workers()
+    data, crop = pad_block(image, kernel)
+    shape = data.shape
+    otf, otf_conj = get_otf(kernel, shape, workers)
+
+    def rl_step(estimate):
+        spectrum = fft.rfftn(estimate, workers=workers)
+        spectrum *= otf
+        blurred = fft.irfftn(spectrum, s=shape, workers=workers, overwrite_x=True)
+        # blurred is reused for the ratio data/blurred, zero where the blurred estimate vanishes
+        small = blurred < epsilon
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(data, blurred, out=blurred)
+        blurred[small] = 0
+        spectrum = fft.rfftn(blurred, workers=workers, overwrite_x=True)
+        spectrum *= otf_conj
+        estimate *= fft.irfftn(spectrum, s=shape, workers=workers, overwrite_x=True)
+        return np.maximum(estimate, 0, out=estimate)
+
+    if stop is not None:
+        callback = stop.bind(data, lambda estimate: convolve(estimate, otf, workers))
+    return rl_iterations(data.copy(), rl_step, niter, acceleration, callback=callback)[crop]
+
+
+def richardson_lucy(image, params=None, algo=None, kernel=None, prepared=True, background=None, niter=10,
+                    acceleration=0, stop=None):
+    """ Same interface as cuda_decon.richardson_lucy, algo is not used """
+    original_data_type = image.dtype
+    destripe_zones = get_filter_zone
+    if params is not None:
+        kernel, prepared = params.kernel, params.prepared
+        niter, acceleration = params.niter, params.acceleration
+        background = params.background
+        destripe_zones = getattr(params, 'destripe', get_filter_zone)
+    else:
+        if kernel is None:
+            kernel = get_kernel(image.shape, sigma=3.9/2.355)
+        if background is None:
+            print('no background specified, using 0.85')
+            background = 0.85
+    if not prepared:
+        image = prepare_decon(image, background, destripe_zones)
+    res = deconvolve(image, kernel['kernel'], niter=niter, acceleration=acceleration, stop=stop)
+    return res.astype(original_data_type, copy=False)
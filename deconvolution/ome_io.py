@@ -0,0 +1,284 @@
+""" Block-wise access to Micro-Manager OME-TIFF stacks, one (t, c) z-stack at a time,
+so that a file never has to be held in memory as a whole. """
+
+import contextlib
+import os
+import time
+import uuid
+from typing import Callable, Tuple
+
+import numpy as np
+import tifffile
+import xmltodict
+
+
+def _no_stage(*args):
+    return contextlib.nullcontext()
+
+
+class OmeTiffReader():
+    """ Read the (t, c) z-stacks of an OME-TIFF file one by one.
+
+    If the pages of the file are stored contiguously and uncompressed they are memory-mapped,
+    otherwise every page is read on its own. Use as a context manager or call close()."""
+
+    def __init__(self, file_dir: str):
+        self.file_dir = file_dir
+        self.tif = tifffile.TiffFile(file_dir)
+        self.ome_metadata = self.tif.ome_metadata
+        self.imagej_metadata = self.tif.imagej_metadata
+        self._memmap = None
+
+        if self.ome_metadata is not None:
+            my_dict = xmltodict.parse(self.ome_metadata, force_list={'Plane'})
+            pixels = my_dict['OME']['Image']["Pixels"]
+            self.size_t = int(pixels["@SizeT"])
+            self.size_z = int(pixels["@SizeZ"])
+            self.size_c = int(pixels["@SizeC"])
+            try:
+                self.z_step = float(pixels['@PhysicalSizeZ'])
+            except KeyError:
+                print("Could not get z step size. Will put default 0.2")
+                self.z_step = 0.2
+            # Lateral pixel size in micrometers, not always stored
+            self.pixel_size = float(pixels.get('@PhysicalSizeX', 0)) or None
+            # 'XYCZT' or 'XYZCT' ?
+            self.dim_order = pixels["@DimensionOrder"]
+            self._pages = self.tif.series[0]
+            n_pages = int(np.prod(self._pages.shape[:-2]))
+        else:
+            print("ATTENION: NO OME METADATA FOUND! RESORT TO BASIC! ASSUME 1 TIME POINT & 1 CHANNEL!")
+            self._pages = self.tif.pages
+            n_pages = len(self._pages)
+            self.dim_order = 'XYCZT'
+            self.size_t = 1
+            self.size_z = n_pages
+            self.size_c = 1
+            self.z_step = 0.2
+            self.pixel_size = None
+
+        # Acquisitions that were stopped early have fewer timepoints than announced
+        complete_t = n_pages//(self.size_z*self.size_c)
+        if complete_t < self.size_t:
+            print(f"Only {complete_t} of {self.size_t} timepoints found in file")
+            self.size_t = complete_t
+
+        first_page = self.tif.pages[0]
+        self.shape = first_page.shape[-2:]
+        self.dtype = first_page.dtype
+        self.ndim = 2 if self.size_z == 1 else 3
+
+        if self.ome_metadata is not None and self._pages.dataoffset is not None:
+            try:
+                self._memmap = np.memmap(self.tif.filehandle.path, mode='r',
+                                         dtype=np.dtype(self.tif.byteorder + self.dtype.char),
+                                         offset=self._pages.dataoffset,
+                                         shape=(n_pages, *self.shape))
+            except (OSError, ValueError) as e:
+                print("Could not memory-map file, will read page by page: ", e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._memmap = None
+        self.tif.close()
+
+    def page_index(self, timepoint: int, channel: int, z: int) -> int:
+        """ Position of a plane in the page sequence of the file """
+        if self.dim_order == 'XYZCT':
+            return z + self.size_z*(channel + self.size_c*timepoint)
+        return channel + self.size_c*(z + self.size_z*timepoint)
+
+    def read_plane(self, timepoint: int, channel: int, z: int) -> np.ndarray:
+        """ Read one (y, x) plane """
+        index = self.page_index(timepoint, channel, z)
+        if self._memmap is not None:
+            return np.asarray(self._memmap[index])
+        page = self._pages[index]
+        if page is None:
+            # Missing planes are stored as empty by tifffile as well
+            return np.zeros(self.shape, dtype=self.dtype)
+        return page.asarray()
+
+    def read_block(self, timepoint: int, channel: int, out: np.ndarray = None) -> np.ndarray:
+        """ Read the z-stack of one timepoint and channel into an array of shape (z, y, x) """
+        if out is None:
+            out = np.empty((self.size_z, *self.shape), dtype=self.dtype)
+        for z in range(self.size_z):
+            out[z] = self.read_plane(timepoint, channel, z)
+        return out
+
+    def sample_frames(self, n_frames: int = 8) -> np.ndarray:
+        """ n_frames planes spread evenly over all timepoints, channels and z, shape (n, y, x) """
+        n_planes = self.size_t*self.size_c*self.size_z
+        planes = np.unique(np.linspace(0, n_planes - 1, min(n_frames, n_planes)).round().astype(int))
+        frames = np.empty((len(planes), *self.shape), dtype=self.dtype)
+        for idx, plane in enumerate(planes):
+            timepoint, rest = divmod(int(plane), self.size_c*self.size_z)
+            frames[idx] = self.read_plane(timepoint, *divmod(rest, self.size_z))
+        return frames
+
+    def blocks(self, start: int = 0, stage: Callable = None):
+        """ Iterate over all (timepoint, channel, z-stack) of the file, skipping the first start
+        blocks without reading them. stage('read', timepoint, channel, nbytes) is entered around
+        every read, like RunReport.stage """
+        block_bytes = self.size_z*int(np.prod(self.shape))*self.dtype.itemsize
+        for index in range(start, self.size_t*self.size_c):
+            timepoint, channel = divmod(index, self.size_c)
+            with (stage or _no_stage)('read', timepoint, channel, block_bytes):
+                block = self.read_block(timepoint, channel)
+            yield timepoint, channel, block
+
+
+def transfer_ome_metadata(ome_metadata: str, out_file: str, size_t: int, file_uuid: str) -> str:
+    """ Adapt the OME-XML of the source file to a single output file written in XYZCT order.
+
+    The file name, UUID and the plane to IFD mapping are set for the new file, planes of
+    timepoints that were not written are removed."""
+    md_info = xmltodict.parse(ome_metadata, force_list={'Plane', 'TiffData'})
+    file_name = os.path.basename(out_file)
+    md_info['OME']['@UUID'] = file_uuid
+    image = md_info['OME']['Image']
+    image['@Name'] = file_name.split('.')[0]
+    pixels = image['Pixels']
+    pixels['@DimensionOrder'] = 'XYZCT'
+    pixels['@SizeT'] = str(size_t)
+    n_planes = size_t*int(pixels['@SizeZ'])*int(pixels['@SizeC'])
+    pixels['TiffData'] = [{'@IFD': '0', '@PlaneCount': str(n_planes),
+                           'UUID': {'@FileName': file_name, '#text': file_uuid}}]
+    if 'Plane' in pixels:
+        pixels['Plane'] = [plane for plane in pixels['Plane'] if int(plane.get('@TheT', 0)) < size_t]
+    return xmltodict.unparse(md_info)
+
+
+def complete_planes(out_file: str, shape, dtype) -> Tuple[int, bool]:
+    """ Number of leading planes of a partially written file whose data is complete, and whether
+    the file holds nothing else (no torn plane of an interrupted write) """
+    try:
+        with tifffile.TiffFile(out_file) as tif:
+            file_size = tif.filehandle.size
+            n_planes, n_pages = 0, 0
+            for page in tif.pages:
+                n_pages += 1
+                # Tiles of compressed planes, the last one in the file is not always the last tile
+                ends = [offset + count for offset, count in zip(page.dataoffsets, page.databytecounts)]
+                if (n_planes == n_pages - 1 and tuple(page.shape) == tuple(shape) and page.dtype == dtype
+                        and ends and max(ends) <= file_size):
+                    n_planes += 1
+            return n_planes, n_planes == n_pages
+    except Exception as e:
+        # A file that was cut off inside its header or first IFD is started anew
+        print("Could not read partial output ", out_file, ": ", e)
+        return 0, False
+
+
+# Lossless codecs for the output, zstd needs imagecodecs
+CODECS = ('zstd', 'zlib', 'lzw')
+TILE = (256, 256)
+
+
+def tiff_options(compression: str = None, level: int = None, predictor: bool = True, tile=TILE,
+                 workers: int = None) -> dict:
+    """ tifffile.write arguments for lossless compression of the tiles of a plane in workers threads,
+    with the horizontal differencing predictor. No compression for None """
+    if compression in (None, 'none', 'None'):
+        return {}
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression {compression}, choose from {CODECS}")
+    if compression == 'zstd':
+        try:
+            import imagecodecs  # noqa: F401
+        except ImportError:
+            print("zstd needs imagecodecs (pip install imagecodecs), using zlib instead")
+            compression = 'zlib'
+    options = {'compression': compression, 'predictor': predictor, 'maxworkers': workers}
+    if level is not None:
+        options['compressionargs'] = {'level': level}
+    if tile:
+        options['tile'] = tuple(tile)
+    return options
+
+
+class OmeTiffWriter():
+    """ Append deconvolved (t, c) z-stacks to a BigTIFF as soon as they are ready.
+
+    Blocks have to be written in the order OmeTiffReader.blocks() yields them. Every block
+    is flushed to disk, so a file of an interrupted run is readable up to the last block.
+    With resume, the complete blocks of such a file are kept and n_written tells where to go on:
+    new planes are appended to a clean file, a file with a torn last plane is rewritten up to
+    its last complete block first.
+
+    compression ('zstd', 'zlib' or 'lzw') compresses the planes losslessly in tiles, see
+    tiff_options. stats has the bytes before and after compression and the time spent writing."""
+
+    def __init__(self, out_file: str, reader: OmeTiffReader, resume: bool = False, compression: str = None,
+                 level: int = None, predictor: bool = True, tile=TILE, workers: int = None):
+        self.out_file = out_file
+        self.options = tiff_options(compression, level, predictor, tile, workers)
+        self.codec = self.options.get('compression', 'none')
+        self.stats = {'raw_bytes': 0, 'stored_bytes': 0, 'seconds': 0.0}
+        self.size_t, self.size_z, self.size_c = reader.size_t, reader.size_z, reader.size_c
+        file_uuid = 'urn:uuid:' + str(uuid.uuid1())
+        if reader.ome_metadata is not None:
+            self.description = transfer_ome_metadata(reader.ome_metadata, out_file,
+                                                     self.size_t, file_uuid)
+        else:
+            ome_xml = tifffile.OmeXml(UUID=file_uuid)
+            ome_xml.addimage(reader.dtype, (self.size_t, self.size_c, self.size_z, *reader.shape),
+                             (self.size_t*self.size_c*self.size_z, 1, 1, *reader.shape, 1),
+                             axes='TCZYX', PhysicalSizeZ=reader.z_step)
+            self.description = ome_xml.tostring()
+        self.n_written = 0
+        n_blocks, clean = 0, False
+        if resume and os.path.exists(out_file):
+            n_planes, clean = complete_planes(out_file, reader.shape, reader.dtype)
+            n_blocks = min(n_planes//self.size_z, self.size_t*self.size_c)
+            clean = clean and n_planes == n_blocks*self.size_z
+        if n_blocks and clean:
+            self.tif = tifffile.TiffWriter(out_file, bigtiff=True, ome=False, append='force')
+            self.n_written = n_blocks
+        elif n_blocks:
+            partial_file = out_file + '.partial'
+            os.replace(out_file, partial_file)
+            self.tif = tifffile.TiffWriter(out_file, bigtiff=True, ome=False)
+            with tifffile.TiffFile(partial_file) as partial:
+                for index in range(n_blocks):
+                    planes = range(index*self.size_z, (index + 1)*self.size_z)
+                    self.write_block(*divmod(index, self.size_c),
+                                     np.stack([partial.pages[plane].asarray() for plane in planes]))
+            os.remove(partial_file)
+            self.stats = {'raw_bytes': 0, 'stored_bytes': 0, 'seconds': 0.0}
+        else:
+            self.tif = tifffile.TiffWriter(out_file, bigtiff=True, ome=False)
+        if n_blocks:
+            print(f"Resuming {out_file} after {n_blocks} of {self.size_t*self.size_c} blocks")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.tif.close()
+
+    def write_block(self, timepoint: int, channel: int, block: np.ndarray):
+        """ Write the z-stack of one timepoint and channel, shape (z, y, x) or (y, x) """
+        if timepoint*self.size_c + channel != self.n_written:
+            raise ValueError(f"Block (t={timepoint}, c={channel}) written out of order")
+        start, position = time.perf_counter(), self.tif.filehandle.tell()
+        # Planes are written one by one, tifffile would otherwise defer the IFDs of a
+        # multi-page write to the next call and the last block could not be recovered
+        for idx, plane in enumerate(block.reshape(-1, *block.shape[-2:])):
+            description = self.description if self.n_written == 0 and idx == 0 else None
+            self.tif.write(plane, photometric='minisblack', description=description, metadata=None,
+                           **self.options)
+        self.tif.filehandle.flush()
+        self.n_written += 1
+        self.stats['raw_bytes'] += block.nbytes
+        self.stats['stored_bytes'] += self.tif.filehandle.tell() - position
+        self.stats['seconds'] += time.perf_counter() - start
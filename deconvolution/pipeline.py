@@ -0,0 +1,131 @@
+""" Overlap reading, computing and writing of blocks with a three stage producer/consumer pipeline.
+
+While block n is computed on the main thread, block n+1 is read (and prepared) and block n-1 is
+written on their own threads. The bounded queues between the stages keep only a few blocks in
+memory at a time. """
+
+import queue
+import threading
+from typing import Callable, Iterable, Sequence
+
+import numpy as np
+
+_DONE = object()
+
+
+class _Failed():
+    """ Passed through the queues to stop the other stages if one of them raised """
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(my_queue: queue.Queue, item, stop: threading.Event):
+    """ Put that gives up if the pipeline was stopped, so no stage is stuck on a full queue """
+    while not stop.is_set():
+        try:
+            my_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _read_stage(blocks: Iterable, read: Callable, out_queue: queue.Queue, stop: threading.Event):
+    try:
+        for block in blocks:
+            if stop.is_set():
+                return
+            _put(out_queue, read(block), stop)
+        _put(out_queue, _DONE, stop)
+    except BaseException as e:
+        _put(out_queue, _Failed(e), stop)
+
+
+def _write_stage(write: Callable, in_queue: queue.Queue, errors: list, stop: threading.Event):
+    while True:
+        block = in_queue.get()
+        if block is _DONE:
+            return
+        try:
+            write(block)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            return
+
+
+class BufferPool():
+    """ Arrays of one shape that the read stage prepares blocks into and compute gives back when it
+    is done with them. A new array is only allocated when none is free, so a pipeline of depth
+    holds depth + 2 of them per block of a batch: one being read, depth waiting, one computed """
+
+    def __init__(self, shape: Sequence[int], dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._free = queue.SimpleQueue()
+
+    def take(self) -> np.ndarray:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return np.empty(self.shape, dtype=self.dtype)
+
+    def give(self, array: np.ndarray):
+        self._free.put(array)
+
+
+def batched(blocks: Iterable, batch_size: int):
+    """ Group blocks into lists of batch_size (the last one can be shorter) """
+    batch = []
+    for block in blocks:
+        batch.append(block)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_pipeline(blocks: Iterable, read: Callable, compute: Callable, write: Callable,
+                 depth: int = 2, progress: Callable = None):
+    """ Run read(block) -> compute(block) -> write(block) for all blocks with the three stages
+    running concurrently. depth is the number of blocks that can wait between two stages.
+    compute runs on the calling thread (TensorFlow sessions and progress bars stay there).
+    progress(result) is called after every computed block. The first error of any stage is re-raised."""
+    stop = threading.Event()
+    read_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=depth)
+    errors = []
+
+    reader = threading.Thread(target=_read_stage, args=(blocks, read, read_queue, stop), daemon=True)
+    writer = threading.Thread(target=_write_stage, args=(write, write_queue, errors, stop), daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while not stop.is_set():
+            try:
+                block = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if block is _DONE:
+                break
+            if isinstance(block, _Failed):
+                raise block.error
+            result = compute(block)
+            _put(write_queue, result, stop)
+            if progress is not None:
+                progress(result)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        # The writer drains what was already computed before it finishes
+        while writer.is_alive():
+            try:
+                write_queue.put(_DONE, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        writer.join()
+        reader.join()
+    if errors:
+        raise errors[0]
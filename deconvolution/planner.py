@@ -0,0 +1,334 @@
+""" Plan how a stack is split for deconvolution so that it fits into the available memory.
+
+The peak memory of a Richardson-Lucy run is estimated from the padded block shape and the working
+buffers the backend keeps per voxel. The plan either runs the whole block, chunks it in z or tiles it
+laterally (and in z if needed), with an overlap taken from the kernel. Of the splits that fit, it
+takes the one with the least padded voxels to deconvolve, margins included. """
+
+import os
+import subprocess
+from dataclasses import dataclass, field
+from itertools import islice, product
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+from scipy import fft
+
+from tiling import get_chunks, get_tiles, kernel_margin
+
+# Bytes per padded voxel at the peak of a Richardson-Lucy iteration. flowdec keeps data, estimate
+# and two intermediate float32 images plus the kernel spectrum, its conjugate and three complex64
+# FFT buffers. The numpy backend holds, while it computes the ratio data/blurred: data, estimate,
+# blurred and the result of the next inverse FFT in float32, the cached OTF and its conjugate and
+# one spectrum (complex64 half spectra, 4 bytes per voxel each) and the bool mask of small values.
+# That is 29 bytes, tracemalloc measures 29 to 29.5 (benchmarks/checks.py), 3 are left for the
+# extra column of the half spectra and small allocations.
+BYTES_PER_VOXEL = {'flowdec': 4*4 + 5*8, 'numpy': 4*4 + 3*4 + 1 + 3}
+# Backends registered without a memory model are planned like the largest known one
+DEFAULT_BYTES_PER_VOXEL = max(BYTES_PER_VOXEL.values())
+# Extra float32 images per voxel that an iteration scheme needs on top of plain RL. Accelerated
+# RL keeps the extrapolated point and its copy for the update, the last estimate(s), the last two
+# updates and the step (measured with tracemalloc: 6 and 7 images).
+SCHEME_BUFFERS = {'rl': 0, 'rl-acc1': 6, 'rl-acc2': 7}
+# Extra float32 images of the stop criteria: the estimate before a check for 'change', the blurred
+# estimate and the masked copies of the I-divergence for 'idiv'
+STOP_BUFFERS = {None: 0, 'change': 1, 'idiv': 2}
+# Leave some room for the framework and fragmentation
+SAFETY = 0.8
+# The tile search tries at most this many tiles per axis
+MAX_TILES_PER_AXIS = 64
+
+
+def parse_size(size: Union[int, float, str]) -> int:
+    """ Bytes from a number or a string like '12G', '500M' """
+    if isinstance(size, str):
+        units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+        size = size.strip().upper().rstrip('B')
+        if size[-1] in units:
+            return int(float(size[:-1])*units[size[-1]])
+    return int(size)
+
+
+def _next_pow2(size: int) -> int:
+    return int(2**np.ceil(np.log2(max(size, 1))))
+
+
+def _numpy_padding(shape: Tuple[int, ...], support: Tuple[int, ...]) -> Tuple[int, ...]:
+    # Reflect padding by the kernel support on both sides, then the next fast FFT size
+    return tuple(fft.next_fast_len(max(size + 2*half, 1), real=True) for size, half in zip(shape, support))
+
+
+def _flowdec_padding(shape: Tuple[int, ...], support: Tuple[int, ...]) -> Tuple[int, ...]:
+    # flowdec pads to the next power of two, accelerated RL and early stopping (tf_deconvolve) pad
+    # like the numpy backend
+    return tuple(max(_next_pow2(size), padded) for size, padded in zip(shape, _numpy_padding(shape, support)))
+
+
+def _default_padding(shape: Tuple[int, ...], support: Tuple[int, ...]) -> Tuple[int, ...]:
+    # Backends registered without a padding: kernel support on both sides and the next power of two
+    return tuple(_next_pow2(size + 2*half) for size, half in zip(shape, support))
+
+
+# padding(shape, kernel support) of a backend, see backends.register
+PADDING = {'flowdec': _flowdec_padding, 'numpy': _numpy_padding}
+
+
+def backend_padded_shape(block_shape: Sequence[int], kernel: np.ndarray = None,
+                         backend: str = 'flowdec') -> Tuple[int, ...]:
+    """ Shape a backend pads a block to before the FFTs, numpy_decon.pad_block uses it as well.
+    A kernel with fewer axes than the block (2D frames batched along a third axis) adds no padding
+    to the leading axes, without kernel only the FFT size counts """
+    block_shape = tuple(int(size) for size in block_shape)
+    support = () if kernel is None else kernel_support(kernel)
+    support = (0,)*(len(block_shape) - len(support)) + tuple(support)
+    return PADDING.get(backend, _default_padding)(block_shape, support)
+
+
+def scheme_name(acceleration: int = 0) -> str:
+    """ Iteration scheme for an acceleration order """
+    return f'rl-acc{acceleration}' if acceleration else 'rl'
+
+
+def estimate_peak_bytes(block_shape: Sequence[int], backend: str = 'flowdec', scheme: str = 'rl',
+                        kernel: np.ndarray = None, stop: str = None) -> int:
+    """ Estimated peak memory of deconvolving one block of block_shape with kernel, stop is the
+    criterion of early stopping ('change', 'idiv' or None) """
+    n_voxels = int(np.prod(backend_padded_shape(block_shape, kernel, backend)))
+    return n_voxels*_bytes_per_voxel(backend, scheme, stop)
+
+
+def _bytes_per_voxel(backend: str, scheme: str, stop: str) -> int:
+    return BYTES_PER_VOXEL.get(backend, DEFAULT_BYTES_PER_VOXEL) + 4*(SCHEME_BUFFERS[scheme] + STOP_BUFFERS[stop])
+
+
+def _mem_available() -> int:
+    """ MemAvailable of /proc/meminfo: free memory plus the page cache that can be reclaimed """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+
+
+def _read_bytes(path: str) -> Union[int, None]:
+    """ Integer in a cgroup file, None if it is missing or unlimited ('max') """
+    try:
+        with open(path) as value:
+            return int(value.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _cgroup_memory() -> Union[int, None]:
+    """ Memory left in the cgroup of this process (a SLURM job or step) and its parents, the
+    smallest limit minus usage. None if there is no limit """
+    try:
+        with open('/proc/self/cgroup') as cgroup:
+            lines = cgroup.read().splitlines()
+    except OSError:
+        return None
+    left = None
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        if controllers == '':  # cgroup v2
+            root, limit_name, usage_name = '/sys/fs/cgroup', 'memory.max', 'memory.current'
+        elif 'memory' in controllers.split(','):  # cgroup v1
+            root, limit_name, usage_name = '/sys/fs/cgroup/memory', 'memory.limit_in_bytes', 'memory.usage_in_bytes'
+        else:
+            continue
+        path = path.strip('/')
+        while True:
+            limit = _read_bytes(os.path.join(root, path, limit_name))
+            usage = _read_bytes(os.path.join(root, path, usage_name))
+            # cgroup v1 reports no limit as a huge number
+            if limit is not None and limit < 2**60:
+                left = min(left, limit - (usage or 0)) if left is not None else limit - (usage or 0)
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return None if left is None else max(left, 0)
+
+
+def _slurm_memory() -> Union[int, None]:
+    """ Memory SLURM granted the job on this node (--mem or --mem-per-cpu), None outside SLURM """
+    try:
+        if os.environ.get('SLURM_MEM_PER_NODE'):
+            return int(os.environ['SLURM_MEM_PER_NODE'])*1024**2
+        if os.environ.get('SLURM_MEM_PER_CPU'):
+            cpus = int(os.environ.get('SLURM_CPUS_ON_NODE') or os.environ.get('SLURM_CPUS_PER_TASK') or 1)
+            return int(os.environ['SLURM_MEM_PER_CPU'])*1024**2*cpus
+    except ValueError:
+        pass
+    return None
+
+
+def _host_memory() -> int:
+    """ Available host memory within the limit of the SLURM job: what is left in the cgroup of
+    this process or, where that can not be read, the memory SLURM granted """
+    available = _mem_available()
+    limit = _cgroup_memory()
+    if limit is None:
+        limit = _slurm_memory()
+    return available if limit is None else min(available, limit)
+
+
+def _gpu_memory() -> Union[int, None]:
+    """ Free memory of the first GPU as reported by nvidia-smi, None if there is no GPU """
+    try:
+        free = subprocess.run(['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+                              capture_output=True, text=True, timeout=10, check=True).stdout
+        return int(free.splitlines()[0])*1024**2
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def detect_budget(backend: str = 'flowdec') -> int:
+    """ Memory available for deconvolution: DECON_MEMORY_BUDGET if set, otherwise the free GPU
+    memory for flowdec on a GPU node and the host memory for everything else """
+    if os.environ.get('DECON_MEMORY_BUDGET'):
+        return parse_size(os.environ['DECON_MEMORY_BUDGET'])
+    gpu_memory = _gpu_memory() if backend == 'flowdec' else None
+    memory = gpu_memory if gpu_memory is not None else _host_memory()
+    return int(memory*SAFETY)
+
+
+def kernel_support(kernel: np.ndarray) -> Tuple[int, ...]:
+    """ Half width of the non-zero part of the kernel per axis """
+    support = []
+    for axis in range(kernel.ndim):
+        profile = np.abs(kernel).sum(axis=tuple(other for other in range(kernel.ndim) if other != axis))
+        nonzero = np.nonzero(profile)[0]
+        center = kernel.shape[axis]//2
+        support.append(int(max(center - nonzero[0], nonzero[-1] - center)) if nonzero.size else 0)
+    return tuple(support)
+
+
+@dataclass
+class MemoryPlan():
+    """ How one (t, c) block is split for deconvolution """
+
+    data_shape: Tuple[int, ...]
+    budget: int
+    backend: str = 'flowdec'
+    scheme: str = 'rl'
+    stop: str = None  # stop criterion of early stopping
+    mode: str = 'whole'  # 'whole', 'z' or 'tiles'
+    n_slices: int = None  # z-chunks: slices per chunk without overlap
+    overlap: int = 0  # z-chunks: slices shared by neighbouring chunks, twice the margin in z
+    tile_shape: Tuple[int, ...] = None  # tiles: core shape of the tiles
+    margin: Tuple[int, ...] = None  # tiles and z-chunks: margin around the cores
+    block_shape: Tuple[int, ...] = field(default=None)  # largest block that is deconvolved at once
+    n_blocks: int = 1
+    peak_bytes: int = 0
+    overhead: float = 1.0  # padded voxels of all blocks per padded voxel of the unsplit block
+
+
+    def report(self) -> str:
+        scheme = self.scheme if self.stop is None else f"{self.scheme}, stop on {self.stop}"
+        lines = [f"Memory plan for {self.data_shape} with {self.backend} ({scheme}):",
+                 f"  mode: {self.mode}, {self.n_blocks} block(s) of up to {self.block_shape}",
+                 f"  estimated peak {self.peak_bytes/1024**3:.2f} GB of {self.budget/1024**3:.2f} GB budget"]
+        if self.mode == 'z':
+            lines.append(f"  {self.n_slices} slices per chunk, overlap {self.overlap}")
+        elif self.mode == 'tiles':
+            lines.append(f"  tiles {self.tile_shape}, margin {self.margin}")
+        if self.mode != 'whole':
+            lines.append(f"  overhead {self.overhead:.2f}x the voxels of the unsplit block (margins and padding)")
+        return "\n".join(lines)
+
+
+def plan_decon(data_shape: Sequence[int], kernel: np.ndarray, niter: int = 10, budget=None,
+               backend: str = 'flowdec', scheme: str = 'rl', stop: str = None) -> MemoryPlan:
+    """ Split a block into z-chunks or tiles that fit into budget (bytes or '12G', detected if
+    None) with the least voxels to deconvolve, margins and padding included """
+    budget = detect_budget(backend) if budget is None else parse_size(budget)
+    data_shape = tuple(int(size) for size in data_shape)
+    plan = MemoryPlan(data_shape, budget, backend, scheme, stop=stop)
+    # The padding of the backend is computed per axis, so the voxels of a split are products of
+    # per axis sums
+    support = kernel_support(kernel)
+    support = (0,)*(len(data_shape) - len(support)) + tuple(support)
+    padding = PADDING.get(backend, _default_padding)
+    max_voxels = budget//_bytes_per_voxel(backend, scheme, stop)
+
+    def padded(extent, axis):
+        return padding((extent,), (support[axis],))[0]
+
+    whole = int(np.prod([padded(size, axis) for axis, size in enumerate(data_shape)]))
+    # Margins are capped at the axis, a larger one would not change any block
+    margin = tuple(min(size, axis_margin) for size, axis_margin in zip(data_shape, kernel_margin(kernel, niter)))
+    if whole <= max_voxels:
+        plan.block_shape = data_shape
+        plan.peak_bytes = estimate_peak_bytes(data_shape, backend, scheme, kernel, stop)
+        return plan
+
+    # Tiles: per axis the cores for 1, 2, ... tiles whenever more tiles make the blocks shorter.
+    # Where the margins are comparable to the axis, splitting it mostly adds margin voxels and the
+    # search below keeps it whole
+    axis_options = []
+    for axis, size in enumerate(data_shape):
+        options = []
+        for n_tiles in range(1, min(size, MAX_TILES_PER_AXIS) + 1):
+            core = -(-size//n_tiles)
+            extents = [slices[0].stop - slices[0].start for slices, _ in get_tiles((size,), (core,), (margin[axis],))]
+            if options and max(extents) >= options[-1][1]:
+                continue
+            options.append((core, max(extents), len(extents), sum(padded(extent, axis) for extent in extents)))
+        axis_options.append(options)
+    # Candidates as (padded voxels of the largest block, of all blocks, mode, cores, block shape, blocks)
+    candidates = []
+    # The first combination leaves every axis whole
+    for options in islice(product(*axis_options), 1, None):
+        block_shape = tuple(option[1] for option in options)
+        candidates.append((int(np.prod([padded(extent, axis) for axis, extent in enumerate(block_shape)])),
+                           int(np.prod([option[3] for option in options])), 'tiles',
+                           tuple(option[0] for option in options), block_shape,
+                           int(np.prod([option[2] for option in options]))))
+    # z-chunks keep the lateral context and need no blending, they win a tie with the tiles.
+    # Their margin covers what niter iterations spread in z, it is cropped again after the
+    # deconvolution (overlap-save)
+    if len(data_shape) == 3:
+        lateral = padded(data_shape[1], 1)*padded(data_shape[2], 2)
+        for n_slices in range(1, data_shape[0] - 2*margin[0]):
+            length = n_slices + 2*margin[0]
+            n_chunks = len(get_chunks(data_shape[0], n_slices, margin[0]))
+            candidates.append((padded(length, 0)*lateral, n_chunks*padded(length, 0)*lateral, 'z', n_slices,
+                               (length, *data_shape[1:]), n_chunks))
+    fitting = [candidate for candidate in candidates if candidate[0] <= max_voxels]
+    if fitting:
+        # The least voxels to deconvolve, then z-chunks, then fewer blocks
+        chosen = min(fitting, key=lambda candidate: (candidate[1], candidate[2] != 'z', candidate[5]))
+    else:
+        # The smallest blocks, unless the margins and padding make them as large as the whole block
+        chosen = min(candidates + [(whole, whole, 'whole', None, data_shape, 1)],
+                     key=lambda candidate: (candidate[0], candidate[2] != 'whole', candidate[1]))
+    _, voxels, plan.mode, core, plan.block_shape, plan.n_blocks = chosen
+    plan.overhead = voxels/whole
+    if plan.mode == 'z':
+        plan.n_slices, plan.margin, plan.overlap = core, (margin[0], 0, 0), 2*margin[0]
+    elif plan.mode == 'tiles':
+        plan.tile_shape, plan.margin = core, margin
+    plan.peak_bytes = estimate_peak_bytes(plan.block_shape, backend, scheme, kernel, stop)
+    if plan.peak_bytes > budget:
+        print("ATTENTION: no split found that fits into the memory budget!")
+    return plan
+
+
+def plan_batch(frame_shape: Sequence[int], n_frames: int, budget=None, backend: str = 'flowdec',
+               scheme: str = 'rl', kernel: np.ndarray = None, stop: str = None) -> int:
+    """ Number of same-shape 2D frames to deconvolve together along a batch axis.
+
+    A power of two, so the backend does not pad the batch axis, and at most the next power of
+    two above n_frames. With early stopping (stop) the frames are not batched: a batch shares one
+    stop criterion, so every frame would run until the slowest one converged."""
+    if stop is not None:
+        return 1
+    budget = detect_budget(backend) if budget is None else parse_size(budget)
+    batch_size = 1
+    while (batch_size < n_frames and
+           estimate_peak_bytes((2*batch_size, *frame_shape), backend, scheme, kernel, stop) <= budget):
+        batch_size = 2*batch_size
+    return batch_size
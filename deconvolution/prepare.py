@@ -1,9 +1,21 @@
 
-""" Mostly for destriping. Might be interesting to do automatic detection of the brightest spots in the future. """
+""" Mostly for destriping. The zones of the stripe peaks are either fixed (get_filter_zone,
+get_filter_zone_ver_stripes) or detected in the power spectrum of the data (detect_stripe_zones). """
+
+import contextlib
+import functools
+from dataclasses import dataclass
+from typing import Callable, Tuple
 
 import numpy as np
 import cv2
+from scipy import fft, ndimage
+
+from background import otsu_levels, parse_quantile, quantile_levels
+from cache import FILTER_MASKS, default_workers
 
+# Voxels that go through the FFTs together, bounds the memory of the spectra
+DESTRIPE_CHUNK = 2**22
 
 
 def get_filter_zone(temp_fft, y_range_param=15, x_range_param=100):
@@ -43,34 +55,163 @@ def get_filter_zone_ver_stripes(temp_fft, y_range_param=200, x_range_param=200):
     return filter_zone
 
 
-def prepare_decon(images, background=0.85, destripe_zones=get_filter_zone):
-    if images.ndim > 2:
-        for idx in range(images.shape[0]):
-            images[idx, :, :] = prepare_one_slice(images[idx, :, :], background, destripe_zones)
-    else:
-        images = prepare_one_slice(images, background, destripe_zones)
-    return images
-
-def prepare_one_slice(image, background, filter_zone_source = get_filter_zone):
-    if background == 'median':
-        background = np.median(image)
-    temp_fft = np.fft.fftshift(np.fft.fft2(image))
-    filter_zone = filter_zone_source(temp_fft)
-    # plt.imshow(np.divide(np.abs(temp_fft),np.max(np.abs(temp_fft))), vmax=0.0001)
-    # plt.show()
-    temp_fft[filter_zone] = 0
-    filtered_img = np.abs(np.fft.ifft2(np.fft.fftshift(temp_fft)))
-    # plt.imshow(np.divide(np.abs(temp_fft),np.max(np.abs(temp_fft))), vmax=0.0001)
-    # plt.show()
-    
-    if background < 3:
-        ret, mask = cv2.threshold(filtered_img.astype(np.uint16), 0, 1,
-                                  cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-        filtered_img = filtered_img - ret*background  # 80
-    else:
-        filtered_img = filtered_img - background
-    filtered_img[filtered_img < 0] = 0
-    return filtered_img
+@dataclass(frozen=True)
+class StripeZones():
+    """ Zone source (like get_filter_zone) for boxes found by detect_stripe_zones.
+
+    boxes are (y_start, y_stop, x_start, x_stop) in the centered spectrum of images of shape,
+    they are scaled for images of other shapes. Hashable, so its masks are cached."""
+
+    shape: Tuple[int, int]
+    boxes: Tuple[Tuple[int, int, int, int], ...] = ()
+
+    def __call__(self, temp_fft):
+        height, width = temp_fft.shape[-2:]
+        scale_y, scale_x = height/self.shape[0], width/self.shape[1]
+        filter_zone = np.zeros((height, width), dtype=bool)
+        for y_start, y_stop, x_start, x_stop in self.boxes:
+            filter_zone[round(y_start*scale_y):round(y_stop*scale_y),
+                        round(x_start*scale_x):round(x_stop*scale_x)] = True
+        return filter_zone
+
+
+def detect_stripe_zones(frames: np.ndarray, core: float = 0.05, threshold: float = 6, margin: int = 2,
+                        max_peaks: int = 4) -> StripeZones:
+    """ Find the stripe peaks in the power spectrum averaged over frames (n, y, x).
+
+    The log power spectrum is flattened with a wide gaussian, peaks that stand out by more than
+    threshold standard deviations are stripes. Frequencies within core (fraction of the image
+    size) of the center carry the image itself and are left alone. Every peak gets the bounding
+    box of its region above threshold plus margin pixels, the max_peaks strongest are kept
+    (power spectra of real images are symmetric, so they come in pairs)."""
+    frames = frames.reshape(-1, *frames.shape[-2:]).astype(np.float32)
+    frames = frames - frames.mean(axis=(-2, -1), keepdims=True)
+    power = np.mean(np.abs(fft.fft2(frames, workers=default_workers()))**2, axis=0)
+    log_power = np.log1p(np.fft.fftshift(power))
+    residual = log_power - ndimage.gaussian_filter(log_power, sigma=max(2, min(frames.shape[-2:])//64))
+
+    height, width = residual.shape
+    y, x = np.ogrid[:height, :width]
+    radius = np.hypot((y - height//2)/height, (x - width//2)/width)
+    outside = residual[radius >= core]
+    level = np.median(outside) + threshold*1.4826*np.median(np.abs(outside - np.median(outside)))
+    regions, n_regions = ndimage.label((residual > level) & (radius >= core))
+
+    zones = []
+    if n_regions:
+        strength = ndimage.maximum(residual, regions, index=np.arange(1, n_regions + 1))
+        objects = ndimage.find_objects(regions)
+        for region in np.argsort(strength)[::-1][:max_peaks]:
+            y_slice, x_slice = objects[region]
+            zones.append((max(0, y_slice.start - margin), min(height, y_slice.stop + margin),
+                          max(0, x_slice.start - margin), min(width, x_slice.stop + margin)))
+    if not zones:
+        print("No stripes found in the power spectrum, nothing will be filtered")
+    return StripeZones((height, width), tuple(zones))
+
+
+def _zone_key(filter_zone_source):
+    """ Hashable key of a zone function, partials of the same function and parameters are equal """
+    if isinstance(filter_zone_source, functools.partial):
+        return (_zone_key(filter_zone_source.func), filter_zone_source.args,
+                tuple(sorted(filter_zone_source.keywords.items())))
+    return filter_zone_source
+
+
+def filter_mask(filter_zone_source, shape) -> np.ndarray:
+    """ Zones of filter_zone_source for images of shape in the centered (fftshift) layout, from the
+    process-wide cache. The zone functions only depend on the shape, the mask is read-only."""
+    shape = tuple(int(size) for size in shape)
+
+    def build():
+        zone = filter_zone_source(np.broadcast_to(np.complex64(0), shape))
+        zone.setflags(write=False)
+        return zone
+    return FILTER_MASKS.get(('centered', _zone_key(filter_zone_source), shape), build)
+
+
+def rfft_filter(filter_zone_source, shape) -> np.ndarray:
+    """ float32 multiplier for the rfft2 half spectrum of images of shape (y, x), from the
+    process-wide cache (read-only).
+
+    filter_zone_source gives the zones to remove in the centered (fftshift) layout, as
+    a boolean mask or as weights from 0 (keep) to 1 (remove). The zones are
+    made point-symmetric, so the filtered images stay real."""
+    shape = tuple(int(size) for size in shape[-2:])
+
+    def build():
+        weights = 1 - np.fft.ifftshift(filter_mask(filter_zone_source, shape)).astype(np.float32)
+        # Frequency -k has to be filtered like k
+        mirrored = np.roll(weights[::-1, ::-1], 1, axis=(0, 1))
+        weights = np.ascontiguousarray(np.minimum(weights, mirrored)[:, :shape[-1]//2 + 1])
+        weights.setflags(write=False)
+        return weights
+    return FILTER_MASKS.get(('rfft', _zone_key(filter_zone_source), shape), build)
+
+
+def destripe_stack(images: np.ndarray, mask: np.ndarray, out: np.ndarray = None, workers: int = None) -> np.ndarray:
+    """ Filter all slices of a (z, y, x) or (y, x) stack with an rfft_filter mask, float32 result in out """
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+    workers = workers or default_workers()
+    stack, out_stack = images.reshape(-1, *images.shape[-2:]), out.reshape(-1, *images.shape[-2:])
+    n_slices = max(1, DESTRIPE_CHUNK//(images.shape[-2]*images.shape[-1]))
+    for start in range(0, stack.shape[0], n_slices):
+        # The float32 copy of the data goes to out, only the spectrum and the inverse are temporary
+        chunk = out_stack[start:start + n_slices]
+        chunk[...] = stack[start:start + n_slices]
+        spectrum = fft.rfft2(chunk, workers=workers)
+        spectrum *= mask
+        chunk[...] = fft.irfft2(spectrum, s=images.shape[-2:], workers=workers, overwrite_x=True)
+    # Magnitude of the filtered image, like the complex per-slice filtering had
+    return np.abs(out, out=out)
+
+
+def _no_stage(name: str, nbytes: int = 0):
+    return contextlib.nullcontext()
+
+
+def prepare_stack(images: np.ndarray, background=0.85, destripe_zones=get_filter_zone,
+                  out: np.ndarray = None, per_stack: bool = False, stage: Callable = None) -> np.ndarray:
+    """ Destripe and subtract the background of every slice of a (z, y, x) or (y, x) stack.
+
+    All slices go through batched real FFTs with one mask, everything is computed in float32 and
+    the result is written to out if given (the input is never modified). destripe_zones None skips destriping.
+    background: 'median' or 'p<percentile>' of the raw data, < 3 Otsu threshold of the destriped
+    data times background, otherwise a fixed value. With per_stack all slices get the level of
+    the whole stack instead of their own. stage(name, nbytes) is entered around the 'destripe'
+    and 'background' steps, like RunReport.stage."""
+    stage = stage or _no_stage
+    if isinstance(background, str):
+        # Quantiles are taken from the raw data before destriping
+        with stage('background', nbytes=images.nbytes):
+            levels = quantile_levels(images, parse_quantile(background), per_stack)
+    with stage('destripe', nbytes=images.nbytes):
+        if destripe_zones is None:
+            if out is None:
+                out = np.empty(images.shape, dtype=np.float32)
+            out[...] = images
+        else:
+            out = destripe_stack(images, rfft_filter(destripe_zones, images.shape[-2:]), out=out)
+    out_stack = out.reshape(-1, *images.shape[-2:])
+
+    with stage('background', nbytes=0 if isinstance(background, str) else out.nbytes):
+        if isinstance(background, str):
+            pass
+        elif background < 3:
+            levels = otsu_levels(out, per_stack)*background
+        else:
+            levels = np.full(out_stack.shape[0], background, dtype=np.float64)
+        out_stack -= levels.astype(np.float32)[:, np.newaxis, np.newaxis]
+        return np.maximum(out, 0, out=out)
+
+
+def prepare_decon(images, background=0.85, destripe_zones=get_filter_zone, out=None, per_stack=False, stage=None):
+    return prepare_stack(images, background, destripe_zones, out=out, per_stack=per_stack, stage=stage)
+
+def prepare_one_slice(image, background, filter_zone_source = get_filter_zone, out=None):
+    """ Destripe and subtract the background of one image, float32 (in out if given) """
+    return prepare_stack(image, background, filter_zone_source, out=out)
 
 def prepare_image(image, background=0.85, median=3, gaussian=1.5):
     prep_img = prepare_decon(image, background).astype(np.uint16)
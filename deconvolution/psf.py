@@ -0,0 +1,48 @@
+""" Kernels (point spread functions) for the deconvolution, independent of the backend. """
+
+import numpy as np
+from scipy import ndimage
+
+from cache import KERNELS
+
+
+def make_kernel(image: np.ndarray, sigma=1.67, z_step=0.2):
+    """Make a gaussian kernel that fits the psf of the microscope"""
+    if image.ndim == 3:
+        z_sigma = 0.48/z_step
+        sigma = [z_sigma, sigma, sigma]
+        print("3D images, sigma: ", sigma)
+
+    size = image.shape
+    size = [min([17, x]) for x in size]
+
+    # If even size dimensions crop to have a center pixel
+    kernel = {'kernel': np.zeros(size, dtype=float),
+              'sigma': sigma}
+    kernel['kernel'][tuple(np.array(kernel['kernel'].shape)//2)] = 1
+    kernel['kernel'] = ndimage.gaussian_filter(kernel['kernel'], sigma=sigma)
+
+
+    kernel['kernel'][kernel['kernel']<1e-6*np.max(kernel['kernel'])] = 0
+    kernel['kernel'] = np.divide(kernel['kernel'], np.sum(kernel['kernel'])).astype(np.float32)
+    return kernel
+
+
+def fit_kernel(kernel: np.ndarray, n_z: int):
+    """Copy of a 3D kernel padded or cropped in z to n_z slices. Its center slice (shape//2, where
+    get_otf expects it) stays the center slice for even and odd n_z"""
+    before = n_z//2 - kernel.shape[0]//2
+    if n_z >= kernel.shape[0]:
+        return np.pad(kernel, ((before, n_z - kernel.shape[0] - before), (0, 0), (0, 0)))
+    kernel = kernel[-before:-before + n_z]
+    return kernel/np.sum(kernel)
+
+
+def get_kernel(shape, sigma=1.67, z_step=0.2):
+    """Kernel for images of this shape from the process-wide cache, the array is read-only"""
+    def build():
+        kernel = make_kernel(np.zeros(shape), sigma=sigma, z_step=z_step)
+        kernel['kernel'].setflags(write=False)
+        return kernel
+    shape = tuple(int(size) for size in shape)
+    return dict(KERNELS.get((shape, len(shape), sigma, z_step), build))
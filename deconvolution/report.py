@@ -0,0 +1,235 @@
+""" Report of a deconvolution run: settings, memory plan, per-block results and the time, bytes and
+memory of every stage, written as JSON (and the stages as CSV) next to the output file. """
+
+import contextlib
+import csv
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field, is_dataclass
+
+import numpy as np
+
+# Stages of a run in the order a block goes through them
+STAGES = ('metadata', 'read', 'destripe', 'background', 'deconvolve', 'postfilter', 'write')
+# Stages that wait for the disk, the others compute
+IO_STAGES = ('metadata', 'read', 'write')
+STAGE_COLUMNS = ('stage', 'timepoint', 'channel', 'blocks', 'seconds', 'bytes', 'peak_bytes')
+
+
+def report_path(out_file: str, suffix: str = '.report.json') -> str:
+    """ <name>_decon.ome.tif.report.json for <name>_decon.ome.tif. The full output name is kept, so
+    the TIFF and the OME-Zarr output of one input have reports of their own """
+    return os.path.normpath(out_file) + suffix
+
+
+def stages_path(out_file: str) -> str:
+    """ <name>_decon.ome.tif.stages.csv for <name>_decon.ome.tif """
+    return report_path(out_file, '.stages.csv')
+
+
+def to_json(value):
+    if is_dataclass(value):
+        return to_json(asdict(value))
+    if isinstance(value, dict):
+        return {str(key): to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, functools.partial):
+        return {'function': to_json(value.func), 'args': to_json(value.args),
+                'keywords': to_json(value.keywords)}
+    if callable(value):
+        return getattr(value, '__name__', repr(value))
+    return value
+
+
+def stage_totals(records: list) -> dict:
+    """ Calls, seconds, bytes, throughput and the largest peak memory per stage, in the order of
+    STAGES. records are stage entries of a RunReport or totals of several runs with their calls """
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'peak_bytes': None})
+        total['calls'] += record.get('calls', 1)
+        total['seconds'] += record['seconds']
+        total['bytes'] += record['bytes']
+        if record['peak_bytes'] is not None:
+            total['peak_bytes'] = max(total['peak_bytes'] or 0, record['peak_bytes'])
+    for total in totals.values():
+        total['mb_per_s'] = total['bytes']/1024**2/max(total['seconds'], 1e-9)
+    order = {name: idx for idx, name in enumerate(STAGES)}
+    return {name: totals[name] for name in sorted(totals, key=lambda name: order.get(name, len(order)))}
+
+
+def stage_summary(totals: dict) -> list:
+    """ Lines with the share of every stage and whether reading and writing or computing took longer """
+    if not totals:
+        return []
+    all_seconds = max(sum(total['seconds'] for total in totals.values()), 1e-9)
+    lines = [f"{'stage':<11} {'seconds':>8} {'share':>6} {'MB/s':>7} {'peak MB':>8}"]
+    for name, total in totals.items():
+        peak = f"{total['peak_bytes']/1024**2:>8.0f}" if total['peak_bytes'] is not None else f"{'-':>8}"
+        lines.append(f"{name:<11} {total['seconds']:>8.2f} {total['seconds']/all_seconds:>6.0%} "
+                     f"{total['mb_per_s']:>7.0f} {peak}")
+    io_seconds = sum(total['seconds'] for name, total in totals.items() if name in IO_STAGES)
+    compute_seconds = all_seconds - io_seconds
+    lines.append(f"I/O {io_seconds:.1f} s, compute {compute_seconds:.1f} s: "
+                 f"{'I/O' if io_seconds > compute_seconds else 'compute'}-bound")
+    return lines
+
+
+@dataclass
+class RunReport():
+    """ Collects what happened to one file """
+
+    file: str
+    output: str = None
+    params: dict = field(default_factory=dict)
+    plan: dict = field(default_factory=dict)
+    blocks: list = field(default_factory=list)
+    memory: list = field(default_factory=list)
+    peak_memory: int = None
+    stages: list = field(default_factory=list)
+    resumed_blocks: int = 0
+    storage: dict = field(default_factory=dict)
+    result_key: str = None
+    started: float = field(default_factory=time.time)
+    finished: float = None
+
+    def __post_init__(self):
+        # The pipeline threads record their stages at the same time
+        self._lock = threading.Lock()
+        self._running = {}
+        self._stage_ids = itertools.count()
+        self._stage_index = {}
+        self._window_peak = 0
+
+    def start_memory_trace(self):
+        """ Trace the allocations of python and numpy (not TensorFlow) with tracemalloc """
+        self._own_trace = not tracemalloc.is_tracing()
+        if self._own_trace:
+            tracemalloc.start()
+        with self._lock:
+            tracemalloc.reset_peak()
+            self._window_peak = 0
+
+    def _observe_peak(self):
+        """ Pass the traced peak on to the running stages and the current window of add_memory """
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        self._window_peak = max(self._window_peak, peak)
+        for running in self._running.values():
+            running['peak_bytes'] = max(running['peak_bytes'], peak)
+
+    def add_memory(self, timepoints_channels):
+        """ Record the traced peak since the last call for the (t, c) stacks that were just done """
+        if not tracemalloc.is_tracing():
+            return
+        with self._lock:
+            self._observe_peak()
+            peak, self._window_peak = self._window_peak, 0
+            tracemalloc.reset_peak()
+        self.peak_memory = max(self.peak_memory or 0, peak)
+        for timepoint, channel in timepoints_channels:
+            self.memory.append({'timepoint': int(timepoint), 'channel': int(channel), 'peak_bytes': peak})
+
+    def stop_memory_trace(self):
+        if getattr(self, '_own_trace', False) and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, timepoint: int = None, channel: int = None, nbytes: int = 0, blocks: int = 1):
+        """ Time one stage (see STAGES) of the block (timepoint, channel) and record the bytes it handled
+        and the traced peak memory while it ran. Stages of other blocks run at the same time on the
+        other pipeline threads, so the peak is the one of the whole process. Repeated calls for the
+        same stage and block add up """
+        with self._lock:
+            self._observe_peak()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            stage_id = next(self._stage_ids)
+            self._running[stage_id] = running = {'peak_bytes': tracemalloc.get_traced_memory()[0]}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._observe_peak()
+                del self._running[stage_id]
+                key = (name, timepoint, channel)
+                record = self._stage_index.get(key)
+                if record is None:
+                    record = {'stage': name, 'timepoint': timepoint, 'channel': channel, 'blocks': blocks,
+                              'seconds': 0.0, 'bytes': 0, 'peak_bytes': None}
+                    self._stage_index[key] = record
+                    self.stages.append(record)
+                record['seconds'] += seconds
+                record['bytes'] += int(nbytes)
+                if tracemalloc.is_tracing():
+                    record['peak_bytes'] = max(record['peak_bytes'] or 0, running['peak_bytes'])
+
+    def stage_totals(self) -> dict:
+        return stage_totals(self.stages)
+
+    def add_block(self, timepoint: int, channel: int, part: int = 0, stop=None, **extra):
+        """ Record one deconvolved block (part: tile or chunk of the (t, c) stack), stop is the
+        Convergence of the run if early stopping was used """
+        block = {'timepoint': int(timepoint), 'channel': int(channel), 'part': int(part)}
+        if stop is not None:
+            block.update({'iterations': stop.iterations, 'residual': stop.residual,
+                          'converged': stop.converged})
+        block.update(extra)
+        self.blocks.append(block)
+
+    def add_storage(self, codec: str, raw_bytes: int, stored_bytes: int, seconds: float):
+        """ Record what writing the output with codec cost: bytes before and after compression and time """
+        entry = self.storage.setdefault(codec, {'raw_bytes': 0, 'stored_bytes': 0, 'seconds': 0.0})
+        entry['raw_bytes'] += int(raw_bytes)
+        entry['stored_bytes'] += int(stored_bytes)
+        entry['seconds'] += seconds
+        entry['ratio'] = entry['raw_bytes']/max(entry['stored_bytes'], 1)
+        entry['mb_per_s'] = entry['raw_bytes']/1024**2/max(entry['seconds'], 1e-9)
+
+    def summary(self) -> str:
+        iterations = [block['iterations'] for block in self.blocks if 'iterations' in block]
+        lines = [f"{len(self.blocks)} block(s) deconvolved in {(self.finished or time.time()) - self.started:.1f} s"]
+        if self.resumed_blocks:
+            lines.append(f"{self.resumed_blocks} (t, c) block(s) kept from a partial output")
+        for codec, entry in self.storage.items():
+            lines.append(f"written with {codec}: {entry['raw_bytes']/1024**2:.0f} MB -> {entry['stored_bytes']/1024**2:.0f} MB, "
+                         f"ratio {entry['ratio']:.2f}, {entry['mb_per_s']:.0f} MB/s")
+        if self.peak_memory is not None:
+            lines.append(f"peak traced memory per stack: max {self.peak_memory/1024**2:.0f} MB")
+        if iterations:
+            converged = sum(block['converged'] for block in self.blocks if 'converged' in block)
+            lines.append(f"iterations per block: min {min(iterations)}, mean {np.mean(iterations):.1f}, "
+                         f"max {max(iterations)}, {converged} of {len(iterations)} converged")
+        lines.extend(stage_summary(self.stage_totals()))
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return to_json({**asdict(self), 'stage_totals': self.stage_totals()})
+
+    def write(self, path: str = None) -> str:
+        """ Write the report as JSON, by default next to the output file """
+        self.finished = self.finished or time.time()
+        path = path or report_path(self.output)
+        with open(path, 'w') as out:
+            json.dump(self.to_dict(), out, indent=2)
+        return path
+
+    def write_stages(self, path: str = None) -> str:
+        """ Write one row per stage and block as CSV, by default next to the output file """
+        path = path or stages_path(self.output)
+        with open(path, 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=STAGE_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.stages)
+        return path
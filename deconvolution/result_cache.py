@@ -0,0 +1,141 @@
+""" Cache of finished deconvolutions, so that an input is not deconvolved twice with the same settings.
+
+A result is keyed on the input file (size, modification time and the OME UUID, or optionally a hash
+of its content), the full parameter set and the version of the code that computes it. The index
+holds one small JSON file per key in ~/.cache/isim_decon/results (DECON_RESULT_CACHE to use another
+directory, e.g. one next to the project that all nodes see), so parallel jobs never write the same
+file. If the output of a key still exists unchanged it is reused, at another place it is linked. """
+
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+import tifffile
+
+from cache import cache_dir
+from report import report_path, stages_path, to_json
+
+# Modules whose code changes the result, the scripts with the user settings are not part of it
+CODE_MODULES = ('background', 'backends', 'cuda_decon', 'numpy_decon', 'ome_io', 'planner', 'prepare',
+                'psf', 'tiling', 'zarr_io')
+HASH_CHUNK = 64*1024**2
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    """ Hash of the sources of CODE_MODULES """
+    digest = hashlib.sha1()
+    for module in CODE_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + '.py'), 'rb') as source:
+            # Line endings depend on the checkout
+            digest.update(source.read().replace(b'\r\n', b'\n'))
+    return digest.hexdigest()[:12]
+
+
+def file_identity(file_dir: str, content: bool = False) -> dict:
+    """ What identifies an input: size, mtime and the OME UUID, or the sha256 of its content """
+    stat = os.stat(file_dir)
+    if content:
+        digest = hashlib.sha256()
+        with open(file_dir, 'rb') as data:
+            for chunk in iter(lambda: data.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+        return {'size': stat.st_size, 'sha256': digest.hexdigest()}
+    file_uuid = None
+    try:
+        with tifffile.TiffFile(file_dir) as tif:
+            match = re.search(r'<OME[^>]*\sUUID="([^"]+)"', tif.pages[0].description or '')
+            file_uuid = match.group(1) if match else None
+    except (tifffile.TiffFileError, OSError, IndexError):
+        pass
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'uuid': file_uuid}
+
+
+def result_key(file_dir: str, params: dict, content: bool = False) -> str:
+    """ Key of the result of deconvolving file_dir with params """
+    text = json.dumps({'input': file_identity(file_dir, content), 'params': to_json(params),
+                       'code': code_version()}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _index_file(key: str) -> str:
+    return os.path.join(os.environ.get('DECON_RESULT_CACHE') or cache_dir('results'), key + '.json')
+
+
+def _signature(out_file: str) -> list:
+    if os.path.isdir(out_file):
+        # OME-Zarr, its attributes are rewritten after every block
+        out_file = os.path.join(out_file, '.zattrs')
+    stat = os.stat(out_file)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _link(source: str, target: str):
+    """ Hard link, symbolic link or, as a last resort, copy source to target (a file or an OME-Zarr) """
+    release(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), target)
+        except OSError:
+            if os.path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copyfile(source, target)
+
+
+def release(out_file: str):
+    """ Remove an old output before a new result is written, it may be a link to another result """
+    if os.path.isdir(out_file) and not os.path.islink(out_file):
+        shutil.rmtree(out_file)
+    elif os.path.lexists(out_file):
+        os.remove(out_file)
+
+
+def _load(key: str) -> dict:
+    try:
+        with open(_index_file(key)) as index:
+            return json.load(index)
+    except (OSError, ValueError):
+        return None
+
+
+def lookup(key: str, out_file: str) -> bool:
+    """ True if the result of key is at out_file, after linking it there if it was found elsewhere """
+    entry = _load(key)
+    # Outputs that were overwritten since, by a run with other settings, do not count
+    outputs = [path for path, signature in (entry or {}).get('outputs', [])
+               if os.path.exists(path) and _signature(path) == signature]
+    if not outputs:
+        return False
+    if not any(os.path.exists(out_file) and os.path.samefile(path, out_file) for path in outputs):
+        print("Linking earlier result ", outputs[0], " to ", out_file)
+        _link(outputs[0], out_file)
+        for path in (report_path, stages_path):
+            if os.path.exists(path(outputs[0])):
+                shutil.copyfile(path(outputs[0]), path(out_file))
+        store(key, out_file, entry['input'])
+    print("Result cached, skipping ", out_file)
+    return True
+
+
+def store(key: str, out_file: str, file_dir: str):
+    """ Record out_file as (one place of) the result of key """
+    index_file = _index_file(key)
+    entry = _load(key) or {'input': os.path.abspath(file_dir), 'code': code_version(), 'created': time.time()}
+    out_file = os.path.abspath(out_file)
+    entry['outputs'] = [[path, signature] for path, signature in entry.get('outputs', []) if path != out_file]
+    entry['outputs'].append([out_file, _signature(out_file)])
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        temp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as index:
+            json.dump(entry, index, indent=2)
+        os.replace(temp_file, index_file)
+    except OSError as e:
+        print("Could not store result in cache: ", e)
@@ -26,7 +26,11 @@ parameters = {
 }
 # background      0-3: otsu with this scaling factor
 # background      > 3: fixed value
-# background 'median': median of each z-stack as bg
+# background 'median': median of each slice as bg, 'p5': 5th percentile
+# background_per_stack True: one level from the whole z-stack for all its slices
+# result_cache False: deconvolve again even if this file was done with the same settings before
+# output_format 'zarr': chunked OME-Zarr with a resolution pyramid instead of the OME-TIFF
+# compression 'zstd' or 'zlib': lossless, tiles compressed in parallel (compression_level, compression_workers)
 
 for file in files:
 
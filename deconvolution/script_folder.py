@@ -2,42 +2,40 @@ import os
 import sys
 os.environ['TF_GPU_ALLOCATOR'] = 'cuda_malloc_async'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
-import tensorflow
-
-gpus = tensorflow.config.list_physical_devices('GPU')
-for gpu in gpus:
-    tensorflow.config.experimental.set_memory_growth(gpu, True)
+# TensorFlow is only needed for the flowdec backend, CPU nodes use the numpy backend
+try:
+    import tensorflow
+    gpus = tensorflow.config.list_physical_devices('GPU')
+    for gpu in gpus:
+        tensorflow.config.experimental.set_memory_growth(gpu, True)
+except ImportError:
+    pass
 
 
 from pathlib import Path
-from prepare import get_filter_zone_ver_stripes, prepare_one_slice
-import cuda_decon
+import batch
 
 # Import
 folder = sys.argv[1]
-
-def list_files(dir):
-    r = []
-    for root, dirs, files in os.walk(dir):
-        for name in files:
-            if name.endswith('.ome.tif'):
-                if not name.startswith('._'):
-                    if not 'decon' in name:
-                        r.append(os.path.join(root, name))
-    return r
+# Optional shard 'i/N', in a SLURM job array the shard of the task is used
+shard = sys.argv[2] if len(sys.argv) > 2 else None
 
 parameters = {
     'background': "median",
+    'backend': 'auto',
 }
 # background      0-3: otsu with this scaling factor
 # background      > 3: fixed value
-# background 'median': median of each z-stack as bg
-
-img_list = list_files(folder)
-print("Found images:")
-print(*img_list, sep = "\n")
-print("STARTING DECON!")
-
-for file in img_list:
-    print(file) 
-    cuda_decon.decon_ome_stack(file, params=parameters)
+# background 'median': median of each slice as bg, 'p5': 5th percentile
+# background_per_stack True: one level from the whole z-stack for all its slices
+# result_cache False: deconvolve again even if this file was done with the same settings before
+# output_format 'zarr': chunked OME-Zarr with a resolution pyramid instead of the OME-TIFF
+# compression 'zstd' or 'zlib': lossless, tiles compressed in parallel (compression_level, compression_workers)
+# backend    'auto': fastest backend on this node (calibrated once), 'flowdec' or 'numpy'
+# destripe_zones 'auto': stripe peaks detected in the power spectrum of each file
+
+# Files that are done according to <folder>/decon_manifest.json are skipped, a file that was
+# interrupted is resumed, so the job can simply be submitted again
+batch.run_batch(folder, parameters, shard=shard)
+# Collect the manifests of all shards into <folder>/decon_batch_report.json
+batch.merge_reports(folder)
@@ -2,11 +2,14 @@ import os
 import sys
 os.environ['TF_GPU_ALLOCATOR'] = 'cuda_malloc_async'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-import tensorflow
-
-gpus = tensorflow.config.list_physical_devices('GPU')
-for gpu in gpus:
-    tensorflow.config.experimental.set_memory_growth(gpu, True)
+# TensorFlow is only needed for the flowdec backend, CPU nodes use the numpy backend
+try:
+    import tensorflow
+    gpus = tensorflow.config.list_physical_devices('GPU')
+    for gpu in gpus:
+        tensorflow.config.experimental.set_memory_growth(gpu, True)
+except ImportError:
+    pass
 
 
 from pathlib import Path
@@ -20,10 +23,17 @@ files = Path(folder).rglob('*.ome.tif')
 
 parameters = {
     'background': "median",
+    'backend': 'auto',
 }
 # background      0-3: otsu with this scaling factor
 # background      > 3: fixed value
-# background 'median': median of each z-stack as bg
+# background 'median': median of each slice as bg, 'p5': 5th percentile
+# background_per_stack True: one level from the whole z-stack for all its slices
+# result_cache False: deconvolve again even if this file was done with the same settings before
+# output_format 'zarr': chunked OME-Zarr with a resolution pyramid instead of the OME-TIFF
+# compression 'zstd' or 'zlib': lossless, tiles compressed in parallel (compression_level, compression_workers)
+# backend    'auto': fastest backend on this node (calibrated once), 'flowdec' or 'numpy'
+# destripe_zones 'auto': stripe peaks detected in the power spectrum of each file
 
 for file in files:
     if not file.name.startswith('._'):
@@ -0,0 +1,113 @@
+""" Split images that are too big for the device into overlapping tiles and blend the results.
+
+Every tile is deconvolved with a margin around its core region. The margins of neighbouring tiles
+are blended with complementary sin^2 ramps that sum to one, so no seams show at the tile borders
+and pixels close to the edge of a tile (where the deconvolution is not reliable) get no weight.
+Stacks split in z only are chunked with overlap-save instead: every chunk keeps just its core. """
+
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+
+def kernel_margin(kernel: np.ndarray, niter: int = 10) -> Tuple[int, ...]:
+    """ Margin per axis that a tile needs so its core is not affected by the tile border.
+
+    Richardson-Lucy applies the kernel twice per iteration, the effective support after niter
+    iterations grows like the width of the kernel times sqrt(2*niter)."""
+    margin = []
+    for axis in range(kernel.ndim):
+        profile = kernel.sum(axis=tuple(other for other in range(kernel.ndim) if other != axis))
+        coords = np.arange(profile.size)
+        mean = np.sum(profile*coords)/np.sum(profile)
+        std = np.sqrt(np.sum(profile*(coords - mean)**2)/np.sum(profile))
+        margin.append(int(np.ceil(3*std*np.sqrt(2*niter))))
+    return tuple(margin)
+
+
+def _axis_tiles(size: int, core: int, margin: int) -> List[Tuple[int, int]]:
+    """ Split an axis into cores of about equal size, each at least as long as the margin """
+    n_tiles = int(np.ceil(size/core))
+    if margin > 0:
+        n_tiles = max(1, min(n_tiles, size//margin))
+    edges = [int(edge) for edge in np.linspace(0, size, n_tiles + 1).round()]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _axis_weights(start: int, stop: int, core_start: int, core_stop: int, size: int,
+                  margin: int) -> np.ndarray:
+    """ 1D blending weights of one tile, ramps are only put where a neighbouring tile exists """
+    coords = np.arange(start, stop) + 0.5
+    weights = np.ones(stop - start, dtype=np.float32)
+    if margin == 0:
+        weights[(coords < core_start) | (coords > core_stop)] = 0
+        return weights
+    if core_start > 0:
+        ramp = np.clip((coords - (core_start - margin/2))/margin, 0, 1)
+        weights *= np.sin(np.pi/2*ramp)**2
+    if core_stop < size:
+        ramp = np.clip(((core_stop + margin/2) - coords)/margin, 0, 1)
+        weights *= np.sin(np.pi/2*ramp)**2
+    return weights
+
+
+def get_tiles(shape: Sequence[int], tile_shape: Sequence[int], margin: Sequence[int]):
+    """ List of (slices of the tile including margin, blending weights) covering an image """
+    axes = []
+    for size, core, axis_margin in zip(shape, tile_shape, margin):
+        axis_tiles = []
+        for core_start, core_stop in _axis_tiles(size, core, axis_margin):
+            start, stop = max(0, core_start - axis_margin), min(size, core_stop + axis_margin)
+            weights = _axis_weights(start, stop, core_start, core_stop, size, axis_margin)
+            axis_tiles.append((slice(start, stop), weights))
+        axes.append(axis_tiles)
+
+    tiles = []
+    for index in np.ndindex(*[len(axis_tiles) for axis_tiles in axes]):
+        slices = tuple(axes[axis][idx][0] for axis, idx in enumerate(index))
+        weights = [axes[axis][idx][1] for axis, idx in enumerate(index)]
+        tiles.append((slices, weights))
+    return tiles
+
+
+def deconvolve_tiled(image: np.ndarray, deconvolve: Callable, tile_shape: Sequence[int],
+                     margin: Sequence[int], out: np.ndarray = None) -> np.ndarray:
+    """ Run deconvolve on overlapping tiles of image and blend the results into out (float32) """
+    if out is None:
+        out = np.zeros(image.shape, dtype=np.float32)
+    else:
+        out[...] = 0
+    for slices, weights in get_tiles(image.shape, tile_shape, margin):
+        tile_weights = weights[0]
+        for axis_weights in weights[1:]:
+            tile_weights = np.multiply.outer(tile_weights, axis_weights)
+        out[slices] += deconvolve(image[slices])*tile_weights
+    return out
+
+
+def get_chunks(size: int, core: int, margin: int) -> List[Tuple[int, int, int]]:
+    """ Overlap-save chunks of an axis as (window start, core start, core stop).
+
+    All windows have the same length core + 2*margin (or size), so they share one kernel and OTF.
+    The cores cover the axis exactly once and stay margin away from the window borders inside the
+    axis; the first and last window are shifted to the ends of the axis and keep larger cores."""
+    length = min(size, core + 2*margin)
+    starts = list(range(0, size - length, max(core, 1))) + [size - length]
+    chunks = []
+    for idx, start in enumerate(starts):
+        core_start = chunks[-1][2] if chunks else 0
+        core_stop = size if idx == len(starts) - 1 else start + length - margin
+        chunks.append((start, core_start, core_stop))
+    return chunks
+
+
+def deconvolve_chunked(image: np.ndarray, deconvolve: Callable, core: int, margin: int,
+                       out: np.ndarray = None) -> np.ndarray:
+    """ Run deconvolve on overlapping chunks of image along the first axis and keep the core of
+    each chunk in out (float32), without blending """
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    length = min(image.shape[0], core + 2*margin)
+    for start, core_start, core_stop in get_chunks(image.shape[0], core, margin):
+        out[core_start:core_stop] = deconvolve(image[start:start + length])[core_start - start:core_stop - start]
+    return out
@@ -0,0 +1,152 @@
+""" Deconvolve OME-TIFF files while the experiment is still being acquired.
+
+    python watch.py <folder> [--params params.json] [--interval 10] [--settle 30] [--idle-exit 0]
+
+The folder is polled every interval seconds. A file is queued once its size and modification time
+have not changed for settle seconds and it has its OME-XML, which Micro-Manager writes when it
+closes the file. One worker thread deconvolves the queued files with batch.run_file in this same
+process, so the backend, its calibration, the kernels and the OTFs stay loaded from one file to
+the next. The manifest of batch.py is used: after a restart files that are done are skipped and an
+interrupted one is resumed. A file that changes again after it was done is deconvolved again. """
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+import backends
+import batch
+from ome_io import OmeTiffReader
+
+
+def is_complete(file_dir: str, require_ome: bool = True) -> bool:
+    """ The file opens and, with require_ome, has its OME metadata """
+    try:
+        with OmeTiffReader(file_dir) as reader:
+            return reader.size_t > 0 and (reader.ome_metadata is not None or not require_ome)
+    except Exception as e:
+        print("Not readable yet ", file_dir, ": ", e)
+        return False
+
+
+class FileWatcher():
+    """ Poll a folder for OME-TIFF files that stopped changing """
+
+    def __init__(self, folder: str, settle: float = 30, require_ome: bool = True):
+        self.folder = folder
+        self.settle = settle
+        self.require_ome = require_ome
+        # path -> ((size, mtime), time since when it has not changed)
+        self._unchanged = {}
+        # path -> (size, mtime) when it was queued
+        self._queued = {}
+
+    def poll(self) -> list:
+        """ Files that became stable since the last poll """
+        now = time.time()
+        stable = []
+        for file_dir in batch.list_files(self.folder):
+            file_dir = os.path.abspath(file_dir)
+            try:
+                stat = os.stat(file_dir)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if self._queued.get(file_dir) == signature:
+                continue
+            previous = self._unchanged.get(file_dir)
+            if previous is None or previous[0] != signature:
+                self._unchanged[file_dir] = (signature, now)
+                continue
+            if now - previous[1] >= self.settle and is_complete(file_dir, self.require_ome):
+                self._queued[file_dir] = signature
+                stable.append(file_dir)
+        return stable
+
+
+def warm_up(params: dict) -> str:
+    """ Load (and if needed calibrate) the backend before the first file arrives """
+    import cuda_decon  # noqa: F401 imports TensorFlow for flowdec
+    name = backends.resolve((params or {}).get('backend', 'auto'))
+    backends.get_backend(name)
+    print("Backend ready: ", name)
+    return name
+
+
+def work(files: queue.Queue, params: dict, manifest: batch.Manifest, attempts: int = 2):
+    """ Deconvolve queued files until None is queued """
+    key = batch.params_hash(params)
+    while True:
+        file_dir = files.get()
+        try:
+            if file_dir is None:
+                return
+            entry = manifest.entry(file_dir, key)
+            if entry['status'] == 'done' and entry['output'] and os.path.exists(entry['output']):
+                print("Already deconvolved ", file_dir)
+                continue
+            manifest.save()
+            print(f"Deconvolving {file_dir}, {files.qsize()} more queued")
+            batch.run_file(entry, params, manifest, attempts)
+        finally:
+            files.task_done()
+
+
+def watch(folder: str, params: dict = None, interval: float = 10, settle: float = 30, idle_exit: float = None,
+          require_ome: bool = True, attempts: int = 2):
+    """ Watch folder until interrupted, or until nothing new came for idle_exit seconds """
+    warm_up(params)
+    manifest = batch.Manifest.load(os.path.join(folder, batch.MANIFEST_NAME))
+    files = queue.Queue()
+    worker = threading.Thread(target=work, args=(files, params, manifest, attempts), daemon=True)
+    worker.start()
+    watcher = FileWatcher(folder, settle, require_ome)
+    last_activity = time.time()
+    print(f"Watching {folder} every {interval} s")
+    try:
+        while worker.is_alive():
+            new_files = watcher.poll()
+            for file_dir in new_files:
+                files.put(file_dir)
+            if new_files or files.unfinished_tasks:
+                last_activity = time.time()
+            elif idle_exit and time.time() - last_activity > idle_exit:
+                print(f"Nothing new for {idle_exit} s, stopping")
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopping after the current file, interrupt again to abort")
+        # Files that are still queued are not done in the manifest, the next start takes them
+        while True:
+            try:
+                files.get_nowait()
+            except queue.Empty:
+                break
+            files.task_done()
+    files.put(None)
+    worker.join()
+    batch.merge_reports(folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help="folder the microscope writes .ome.tif files to")
+    parser.add_argument('--params', help="JSON file with the decon_ome_stack parameters")
+    parser.add_argument('--interval', type=float, default=10, help="seconds between polls")
+    parser.add_argument('--settle', type=float, default=30, help="seconds a file has to stay unchanged")
+    parser.add_argument('--idle-exit', type=float, default=0, help="stop after this many idle seconds, 0: never")
+    parser.add_argument('--no-ome-check', action='store_true', help="also take files without OME metadata")
+    parser.add_argument('--attempts', type=int, default=2, help="tries per file")
+    args = parser.parse_args()
+    params = {'background': 'median', 'backend': 'auto'}
+    if args.params:
+        with open(args.params) as params_file:
+            params = json.load(params_file)
+    watch(args.folder, params, args.interval, args.settle, args.idle_exit or None, not args.no_ome_check,
+          args.attempts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+""" OME-Zarr (NGFF 0.4) output, written (t, c) z-stack by z-stack with a multiscale pyramid.
+
+Every level is a (t, c, z, y, x) array with chunks of (1, 1, z_chunk, yx_chunk, yx_chunk),
+compressed with blosc/zstd. The lower resolution levels are binned 2x2 in y and x from the block
+that was just written, so the pyramid costs no second pass over the data. Viewers like napari and
+Fiji (MoBIE) then only read the chunks they show. Needs zarr 2 (pip install "zarr<3"). """
+
+import os
+import shutil
+import time
+
+import numpy as np
+
+from ome_io import OmeTiffReader
+
+# (z, y, x) chunk shape, about 4 MB of uint16
+CHUNKS = (8, 512, 512)
+# Levels are added until the image fits into one chunk in y and x
+MAX_LEVELS = 5
+
+
+def downsample(block: np.ndarray) -> np.ndarray:
+    """ Mean of 2x2 pixels in y and x, a last odd row or column is dropped """
+    y, x = block.shape[-2]//2*2, block.shape[-1]//2*2
+    binned = block[..., :y, :x].astype(np.float32).reshape(*block.shape[:-2], y//2, 2, x//2, 2).mean(axis=(-3, -1))
+    if np.issubdtype(block.dtype, np.integer):
+        binned = np.rint(binned)
+    return binned.astype(block.dtype)
+
+
+def n_levels(shape, yx_chunk: int, max_levels: int = MAX_LEVELS) -> int:
+    """ Pyramid levels for a (y, x) shape, down to one chunk """
+    levels = 1
+    while levels < max_levels and max(shape) > yx_chunk and min(shape) >= 2:
+        shape = [size//2 for size in shape]
+        levels += 1
+    return levels
+
+
+class OmeZarrWriter():
+    """ Write deconvolved (t, c) z-stacks to an OME-Zarr as soon as they are ready, same interface as
+    ome_io.OmeTiffWriter. The number of written blocks is kept in the attributes, so with resume an
+    interrupted output goes on after its last complete block. """
+
+    def __init__(self, out_file: str, reader: OmeTiffReader, resume: bool = False, chunks=None,
+                 levels: int = None, clevel: int = 5):
+        try:
+            import zarr
+            from numcodecs import Blosc
+        except ImportError as e:
+            raise ImportError("OME-Zarr output needs zarr 2, pip install 'zarr<3'") from e
+        self.out_file = out_file
+        self.size_t, self.size_z, self.size_c = reader.size_t, reader.size_z, reader.size_c
+        z_chunk, *yx_chunk = chunks or CHUNKS
+        self.n_written = 0
+        self.codec = f"blosc-zstd{clevel}"
+        self.stats = {'raw_bytes': 0, 'stored_bytes': 0, 'seconds': 0.0}
+        if resume and os.path.exists(os.path.join(out_file, '.zattrs')):
+            self.group = zarr.open_group(out_file, mode='r+')
+            if self.group['0'].shape == (self.size_t, self.size_c, self.size_z, *reader.shape):
+                self.n_written = self.group.attrs.get('decon', {}).get('written', 0)
+                self.levels = len(self.group.attrs['multiscales'][0]['datasets'])
+                print(f"Resuming {out_file} after {self.n_written} of {self.size_t*self.size_c} blocks")
+                return
+        if os.path.isdir(out_file):
+            shutil.rmtree(out_file)
+        self.levels = levels or n_levels(reader.shape, max(yx_chunk))
+        self.group = zarr.open_group(out_file, mode='w')
+        compressor = Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+        shape = list(reader.shape)
+        for level in range(self.levels):
+            self.group.create_dataset(str(level), shape=(self.size_t, self.size_c, self.size_z, *shape),
+                                      chunks=(1, 1, min(z_chunk, self.size_z), *yx_chunk), dtype=reader.dtype,
+                                      compressor=compressor, dimension_separator='/', fill_value=0)
+            shape = [size//2 for size in shape]
+        pixel_size = reader.pixel_size or 1
+        unit = {'unit': 'micrometer'} if reader.pixel_size else {}
+        datasets = [{'path': str(level),
+                     'coordinateTransformations': [{'type': 'scale', 'scale': [1, 1, reader.z_step, pixel_size*2**level,
+                                                                               pixel_size*2**level]}]}
+                    for level in range(self.levels)]
+        self.group.attrs['multiscales'] = [{
+            'version': '0.4',
+            'name': os.path.basename(out_file).split('.')[0],
+            'axes': [{'name': 't', 'type': 'time'}, {'name': 'c', 'type': 'channel'},
+                     {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                     {'name': 'y', 'type': 'space', **unit}, {'name': 'x', 'type': 'space', **unit}],
+            'datasets': datasets,
+            'type': 'mean',
+        }]
+        self.group.attrs['decon'] = {'written': 0, 'source': os.path.basename(reader.file_dir)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Nothing is buffered, every block is in its chunk files once write_block returns. The
+        # stored size is only known for the whole output, the raw size is counted for it as well
+        self.stats['stored_bytes'] = sum(os.path.getsize(os.path.join(root, name))
+                                         for root, _, names in os.walk(self.out_file) for name in names)
+        self.stats['raw_bytes'] = sum(self.group[str(level)].nbytes*self.n_written//(self.size_t*self.size_c)
+                                      for level in range(self.levels))
+
+    def write_block(self, timepoint: int, channel: int, block: np.ndarray):
+        """ Write the z-stack of one timepoint and channel, shape (z, y, x) or (y, x), on all levels """
+        if timepoint*self.size_c + channel != self.n_written:
+            raise ValueError(f"Block (t={timepoint}, c={channel}) written out of order")
+        start = time.perf_counter()
+        block = block.reshape(-1, *block.shape[-2:])
+        for level in range(self.levels):
+            if level:
+                block = downsample(block)
+            self.group[str(level)][timepoint, channel] = block
+        self.n_written += 1
+        self.group.attrs['decon'] = {**self.group.attrs['decon'], 'written': self.n_written}
+        self.stats['seconds'] += time.perf_counter() - start
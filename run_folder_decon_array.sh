@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Deconvolve a folder with a SLURM job array, every task takes one shard of the files.
+# Shards are balanced by file size, so the job takes about as long as its largest shard.
+#   sbatch --array=0-7 run_folder_decon_array.sh /path/to/folder
+# Submitting the same command again only runs what is not done yet.
+
+#SBATCH --ntasks=1
+#SBATCH --mem-per-cpu=32G
+#SBATCH --gpus=1
+#SBATCH --gres=gpumem:16G
+#SBATCH --array=0-3
+#SBATCH --output=decon_%A_%a.out
+
+module purge
+
+module load stack/2024-06
+module load gcc/12.2.0
+module load python_cuda/3.9.18
+module load cuda/12.1.1
+module load cudnn/8.9.7.29-12
+
+# Avoiding the JIT error
+export XLA_FLAGS=--xla_gpu_cuda_data_dir=$CUDA_EULER_ROOT
+export CUDA_DIR=$CUDA_EULER_ROOT
+
+# Checking the inputs
+if [ $# -eq 0 ];
+then
+  echo "$0: Missing arguments"
+  exit 1
+elif [ $# -gt 1 ];
+then
+  echo "$0: Too many arguments: $@"
+  exit 1
+else
+  echo "Reading folder: $1, task $SLURM_ARRAY_TASK_ID of array $SLURM_ARRAY_JOB_ID"
+fi
+
+# Enter folder with python script
+cd deconvolution
+
+# The shard of this task comes from SLURM_ARRAY_TASK_ID, every task also merges the
+# per-shard reports, the last one to finish leaves the complete decon_batch_report.json
+python script_folder.py $1
+
+# Return to initial location
+cd ..